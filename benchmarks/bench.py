@@ -0,0 +1,303 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Offline benchmarks of image lookups against a recorded streams snapshot.
+
+Record a snapshot of the mirrors once:
+
+    python3 benchmarks/bench.py record benchmarks/snapshot
+
+Then measure every cloud against it without network access:
+
+    python3 benchmarks/bench.py run benchmarks/snapshot
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from ubuntu_cloud_image import streams, sync  # noqa: E402
+from ubuntu_cloud_image.image import (  # noqa: E402
+    CLOUDS,
+    DEFAULT_REGIONS,
+    MIRRORS,
+    default_keyring_path,
+)
+
+DEFAULT_SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot")
+DEFAULT_RELEASE = "focal"
+DEFAULT_ARCH = "amd64"
+DEFAULT_REPEAT = 3
+
+INDEX_PATH = "streams/v1/index.sjson"
+
+
+def snapshot_url(snapshot, mirror_url):
+    """Return the file:// URL of a mirror in a snapshot.
+
+    Args:
+        snapshot: directory of the snapshot
+        mirror_url: URL of the streams mirror
+
+    Returns:
+        file:// URL of the copy of the mirror
+
+    """
+    return streams.local_mirror_url(snapshot, mirror_url)
+
+
+def record(snapshot, mirrors=None):
+    """Download the signed streams of the mirrors into a snapshot.
+
+    Only the product files of the content the clouds look up are kept.
+
+    Args:
+        snapshot: directory to write the snapshot to
+        mirrors: list of mirror URLs (default: every known mirror)
+    """
+    content_ids = {cloud.content_id for cloud in CLOUDS.values()}
+    for mirror_url in mirrors or MIRRORS:
+        base = urllib.parse.unquote(
+            urllib.parse.urlsplit(snapshot_url(snapshot, mirror_url)).path
+        )
+        paths = [INDEX_PATH]
+
+        index = json.loads(
+            sync.s_util.read_signed(
+                _download(mirror_url, INDEX_PATH, base), checked=False
+            )
+        )
+        for content_id, entry in index.get("index", {}).items():
+            if content_id.rpartition(":")[2] in content_ids and entry.get("path"):
+                paths.append(entry["path"])
+                _download(mirror_url, entry["path"], base)
+
+        print("recorded %s files of %s" % (len(paths), mirror_url))
+
+
+def _download(mirror_url, path, base):
+    """Download a file of a mirror into the snapshot directory."""
+    with urllib.request.urlopen(mirror_url + path) as response:
+        content = response.read()
+
+    target = os.path.join(base, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as target_file:
+        target_file.write(content)
+
+    return content.decode("utf-8")
+
+
+def default_image(name, keyring_path=None, release=DEFAULT_RELEASE, arch=DEFAULT_ARCH):
+    """Create the Image of a cloud with default arguments.
+
+    Args:
+        name: cloud name as used by the CLI (e.g. aws)
+        keyring_path: keyring to verify with instead of the default one
+        release: Ubuntu release codename
+        arch: architecture of the image
+
+    Returns:
+        Image instance
+
+    """
+    cloud = CLOUDS[name]
+    if keyring_path:
+        cloud = type(cloud.__name__, (cloud,), {"keyring_path": keyring_path})
+
+    if name in DEFAULT_REGIONS:
+        return cloud(release, arch, DEFAULT_REGIONS[name])
+
+    return cloud(release, arch)
+
+
+class Counters:
+    """Time spent verifying signatures and bytes parsed during a lookup.
+
+    The simplestreams functions used by the sync module are wrapped
+    while the counters are installed.
+    """
+
+    def __init__(self):
+        """Initialize Counters class."""
+        self.gpg_time = 0.0
+        self.bytes_parsed = 0
+        self._originals = None
+
+    def __enter__(self):
+        """Wrap read_signed and load_content."""
+        read_signed = sync.s_util.read_signed
+        load_content = sync.s_util.load_content
+
+        def timed_read_signed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return read_signed(*args, **kwargs)
+            finally:
+                self.gpg_time += time.perf_counter() - start
+
+        def counted_load_content(content):
+            self.bytes_parsed += len(content)
+            return load_content(content)
+
+        self._originals = (read_signed, load_content)
+        sync.s_util.read_signed = timed_read_signed
+        sync.s_util.load_content = counted_load_content
+
+        return self
+
+    def __exit__(self, *args):
+        """Restore the simplestreams functions."""
+        (sync.s_util.read_signed, sync.s_util.load_content) = self._originals
+
+
+def measure(image, repeat, **kwargs):
+    """Run the lookup of an image and measure it.
+
+    Wall and gpg times are the median of the runs, peak memory is taken
+    from a separate run as tracing allocations slows down the lookup.
+
+    Args:
+        image: Image instance with mirror_url pointing to the snapshot
+        repeat: number of timed runs
+        kwargs: additional arguments passed to Streams
+
+    Returns:
+        dictionary of the measurements
+
+    """
+    walls = []
+    gpg_times = []
+    for _ in range(repeat):
+        with Counters() as counters:
+            start = time.perf_counter()
+            result = image.search(**kwargs)
+            walls.append(time.perf_counter() - start)
+        gpg_times.append(counters.gpg_time)
+
+    tracemalloc.start()
+    try:
+        image.search(**kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "wall": statistics.median(walls),
+        "gpg": statistics.median(gpg_times),
+        "bytes_parsed": counters.bytes_parsed,
+        "peak_memory": peak,
+        "found": bool(result),
+    }
+
+
+def run(snapshot, clouds=None, repeat=DEFAULT_REPEAT, keyring_path=None, **kwargs):
+    """Benchmark the lookup of every cloud against a snapshot.
+
+    Args:
+        snapshot: directory of the recorded snapshot
+        clouds: list of cloud names (default: every cloud)
+        repeat: number of timed runs per cloud
+        keyring_path: keyring the snapshot is verified with
+        kwargs: additional arguments passed to Streams (e.g. verify)
+
+    Returns:
+        dictionary of cloud name to measurements
+
+    """
+    results = {}
+    for name in clouds or CLOUDS:
+        image = default_image(name, keyring_path)
+        image.mirror_url = snapshot_url(snapshot, image.mirror_url)
+
+        results[name] = measure(image, repeat, cache=None, **kwargs)
+
+    return results
+
+
+def report(results):
+    """Print the measurements as a table."""
+    print(
+        "%-14s %10s %10s %14s %12s %6s"
+        % ("cloud", "wall (s)", "gpg (s)", "bytes parsed", "peak (KiB)", "found")
+    )
+    for name, result in results.items():
+        print(
+            "%-14s %10.3f %10.3f %14d %12d %6s"
+            % (
+                name,
+                result["wall"],
+                result["gpg"],
+                result["bytes_parsed"],
+                result["peak_memory"] // 1024,
+                "yes" if result["found"] else "no",
+            )
+        )
+
+
+def parse_args():
+    """Set up command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    record_parser = subparsers.add_parser("record", help="record a snapshot")
+    record_parser.add_argument("snapshot", nargs="?", default=DEFAULT_SNAPSHOT)
+    record_parser.add_argument(
+        "--mirror", action="append", help="mirror URL to record (default: all)"
+    )
+
+    run_parser = subparsers.add_parser("run", help="benchmark against a snapshot")
+    run_parser.add_argument("snapshot", nargs="?", default=DEFAULT_SNAPSHOT)
+    run_parser.add_argument(
+        "--cloud",
+        action="append",
+        choices=sorted(CLOUDS),
+        help="cloud to benchmark (default: all)",
+    )
+    run_parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    run_parser.add_argument(
+        "--keyring",
+        default=default_keyring_path(),
+        help="keyring to verify the snapshot with",
+    )
+    run_parser.add_argument(
+        "--no-verify", action="store_true", help="skip signature checks"
+    )
+    run_parser.add_argument("--workers", type=int, default=streams.DEFAULT_WORKERS)
+    run_parser.add_argument("--json", action="store_true", help="output JSON")
+
+    return parser.parse_args()
+
+
+def main():
+    """Record a snapshot or benchmark against it."""
+    args = parse_args()
+
+    if args.command == "record":
+        record(args.snapshot, args.mirror)
+        return
+
+    results = run(
+        args.snapshot,
+        clouds=args.cloud,
+        repeat=args.repeat,
+        keyring_path=args.keyring,
+        verify=not args.no_verify,
+        workers=args.workers,
+    )
+    if args.json:
+        print(json.dumps(results, sort_keys=True, indent=4))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
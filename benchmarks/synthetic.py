@@ -0,0 +1,411 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Synthetic streams to measure how lookups scale with the mirror size.
+
+Write a signed tree of products x versions x items x regions:
+
+    python3 benchmarks/synthetic.py generate /tmp/streams --regions 100
+
+Measure a lookup while one dimension grows, served over local HTTP:
+
+    python3 benchmarks/synthetic.py scale --dimension regions
+"""
+
+import argparse
+import http.server
+import json
+import os
+import posixpath
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from ubuntu_cloud_image.predicate import Predicate  # noqa: E402
+from ubuntu_cloud_image.streams import Streams  # noqa: E402
+from ubuntu_cloud_image.sync import FilterMirror  # noqa: E402
+
+CONTENT_ID = "com.ubuntu.cloud:released:aws"
+PRODUCTS_PATH = "streams/v1/%s.sjson" % CONTENT_ID
+INDEX_PATH = "streams/v1/index.sjson"
+
+DIMENSIONS = {"products": 4, "versions": 10, "items": 2, "regions": 10}
+DEFAULT_FACTORS = (1, 2, 5, 10)
+DEFAULT_REPEAT = 3
+
+
+def build_products(products=4, versions=10, items=2, regions=10):
+    """Build an AWS like products tree of the given size.
+
+    Args:
+        products: number of products (releases)
+        versions: number of versions (serials) of each product
+        items: number of items per region of each version
+        regions: number of regions of each version
+
+    Returns:
+        products:1.0 dictionary
+
+    """
+    tree = {
+        "content_id": CONTENT_ID,
+        "datatype": "image-ids",
+        "format": "products:1.0",
+        "updated": "Mon, 01 Mar 2021 00:00:00 +0000",
+        "products": {},
+    }
+    for product in range(products):
+        release = "release%03d" % product
+        versions_tree = {}
+        for version in range(versions):
+            serial = "2021%04d" % (version + 101)
+            items_tree = {}
+            for region in range(regions):
+                for item in range(items):
+                    items_tree["r%03di%03d" % (region, item)] = {
+                        "crsn": "region-%03d" % region,
+                        "endpoint": "https://ec2.region-%03d.amazonaws.com" % region,
+                        "id": "ami-%s%s%03d%03d" % (product, serial, region, item),
+                        "region": "region-%03d" % region,
+                        "root_store": "store%03d" % item,
+                        "virt": "hvm",
+                    }
+            versions_tree[serial] = {"label": "release", "items": items_tree}
+        tree["products"]["com.ubuntu.cloud:server:%s:amd64" % release] = {
+            "arch": "amd64",
+            "os": "ubuntu",
+            "release": release,
+            "version": "%02d.04" % product,
+            "versions": versions_tree,
+        }
+
+    return tree
+
+
+def build_index(tree):
+    """Build the index of a products tree."""
+    return {
+        "format": "index:1.0",
+        "updated": tree["updated"],
+        "index": {
+            CONTENT_ID: {
+                "datatype": tree["datatype"],
+                "format": tree["format"],
+                "path": PRODUCTS_PATH,
+                "products": sorted(tree["products"]),
+                "updated": tree["updated"],
+            }
+        },
+    }
+
+
+class Signer:
+    """Clearsign content with a throwaway GPG key."""
+
+    def __init__(self, home):
+        """Create the key in a new GPG home directory.
+
+        Args:
+            home: directory for the GPG home, created if missing
+        """
+        self.home = home
+        os.makedirs(home, mode=0o700, exist_ok=True)
+        self._gpg(
+            "--pinentry-mode",
+            "loopback",
+            "--passphrase",
+            "",
+            "--quick-gen-key",
+            "Synthetic Streams <synthetic@example.com>",
+            "default",
+            "default",
+            "never",
+        )
+
+    def _gpg(self, *args, content=None):
+        """Run gpg in the home directory and return its output."""
+        return subprocess.run(
+            ["gpg", "--batch", "--homedir", self.home] + list(args),
+            input=content,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        ).stdout
+
+    def sign(self, content):
+        """Clearsign content."""
+        return self._gpg("--clearsign", content=content)
+
+    def export(self, keyring_path):
+        """Write the public key to a keyring usable by gpgv."""
+        with open(keyring_path, "wb") as keyring_file:
+            keyring_file.write(self._gpg("--export"))
+
+    def close(self):
+        """Stop the gpg-agent started for the home directory."""
+        subprocess.run(
+            ["gpgconf", "--homedir", self.home, "--kill", "all"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def generate(path, sign=True, **sizes):
+    """Write a synthetic mirror.
+
+    Args:
+        path: directory to write the mirror to
+        sign: clearsign the files, writing the key to keyring.gpg
+        sizes: products, versions, items and regions counts
+
+    Returns:
+        path to the keyring, None if the files are not signed
+
+    """
+    tree = build_products(**sizes)
+    signer = None
+    keyring_path = None
+    if sign:
+        signer = Signer(os.path.join(path, "gnupg"))
+        keyring_path = os.path.join(path, "keyring.gpg")
+        signer.export(keyring_path)
+
+    try:
+        for file_path, data in ((PRODUCTS_PATH, tree), (INDEX_PATH, build_index(tree))):
+            content = json.dumps(data, indent=1).encode("utf-8")
+            if signer:
+                content = signer.sign(content)
+
+            target = os.path.join(path, file_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as target_file:
+                target_file.write(content)
+    finally:
+        if signer:
+            signer.close()
+
+    return keyring_path
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """Serve the files of a directory."""
+
+    root = None
+
+    def translate_path(self, path):
+        """Map a URL path to a file under the root directory."""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        path = posixpath.normpath(path)
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Silence request logging."""
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded HTTP server."""
+
+    daemon_threads = True
+
+
+class Mirror:
+    """Serve a directory over local HTTP while in use as a context."""
+
+    def __init__(self, path):
+        """Initialize Mirror class.
+
+        Args:
+            path: directory to serve
+        """
+        handler = type("Handler", (Handler,), {"root": os.path.abspath(path)})
+        self.server = Server(("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:%s/" % self.server.server_port
+
+    def __enter__(self):
+        """Start serving."""
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def lookup_filter(sizes):
+    """Filter matching the last item of the newest product like a user would."""
+    return [
+        "arch=amd64",
+        "region=region-%03d" % (sizes["regions"] - 1),
+        "release=release%03d" % (sizes["products"] - 1),
+        "root_store=store%03d" % (sizes["items"] - 1),
+        "virt=hvm",
+    ]
+
+
+def time_filter(tree, img_filter, repeat):
+    """Time FilterMirror alone on an already parsed tree."""
+    timings = []
+    for _ in range(repeat):
+        mirror = FilterMirror({"filters": Predicate(img_filter), "latest_only": True})
+        start = time.perf_counter()
+        mirror.sync_products(None, src=tree, content="")
+        results = mirror.results
+        timings.append(time.perf_counter() - start)
+    if not results[0]:
+        raise RuntimeError("lookup did not match the synthetic streams")
+
+    return min(timings)
+
+
+def time_query(url, keyring_path, img_filter, repeat):
+    """Time Streams.query against a served mirror."""
+    timings = []
+    for _ in range(repeat):
+        stream = Streams(url, keyring_path, verify=keyring_path is not None)
+        start = time.perf_counter()
+        result = stream.query(img_filter, latest_only=True)
+        timings.append(time.perf_counter() - start)
+    if not result:
+        raise RuntimeError("lookup did not match the synthetic streams")
+
+    return min(timings)
+
+
+def scale(dimension, factors=DEFAULT_FACTORS, sign=True, repeat=DEFAULT_REPEAT):
+    """Measure a lookup while one dimension of the streams grows.
+
+    Args:
+        dimension: products, versions, items or regions
+        factors: multipliers applied to the default size of the dimension
+        sign: sign the streams and verify them during the lookup
+        repeat: number of runs, the fastest is kept
+
+    Returns:
+        list of dictionaries of the measurements of each factor
+
+    """
+    results = []
+    for factor in factors:
+        sizes = dict(DIMENSIONS)
+        sizes[dimension] *= factor
+        item_count = 1
+        for size in sizes.values():
+            item_count *= size
+
+        path = tempfile.mkdtemp(prefix="synthetic-streams-")
+        try:
+            keyring_path = generate(path, sign=sign, **sizes)
+            img_filter = lookup_filter(sizes)
+            with Mirror(path) as mirror:
+                query_time = time_query(mirror.url, keyring_path, img_filter, repeat)
+        finally:
+            shutil.rmtree(path)
+
+        filter_time = time_filter(build_products(**sizes), img_filter, repeat)
+        results.append(
+            {
+                "factor": factor,
+                "items": item_count,
+                "query": query_time,
+                "filter": filter_time,
+            }
+        )
+
+    return results
+
+
+def report(dimension, results):
+    """Print the measurements with the time per item relative to the base.
+
+    A relative cost per item well above 1.0 as the streams grow points at
+    superlinear behaviour.
+    """
+    print("scaling %s" % dimension)
+    print(
+        "%6s %10s %10s %10s %12s %12s"
+        % ("factor", "items", "query (s)", "filter (s)", "query/item", "filter/item")
+    )
+    base = results[0]
+    for result in results:
+        print(
+            "%6s %10d %10.3f %10.3f %12.2f %12.2f"
+            % (
+                result["factor"],
+                result["items"],
+                result["query"],
+                result["filter"],
+                (result["query"] / result["items"]) / (base["query"] / base["items"]),
+                (result["filter"] / result["items"]) / (base["filter"] / base["items"]),
+            )
+        )
+
+
+def parse_args():
+    """Set up command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    generate_parser = subparsers.add_parser("generate", help="write a mirror")
+    generate_parser.add_argument("path")
+    for dimension, size in DIMENSIONS.items():
+        generate_parser.add_argument("--%s" % dimension, type=int, default=size)
+    generate_parser.add_argument(
+        "--unsigned", action="store_true", help="do not sign the streams"
+    )
+
+    scale_parser = subparsers.add_parser("scale", help="measure scaling")
+    scale_parser.add_argument(
+        "--dimension", choices=sorted(DIMENSIONS), default="regions"
+    )
+    scale_parser.add_argument(
+        "--factor",
+        type=int,
+        action="append",
+        help="size multiplier (default: %s)" % ", ".join(map(str, DEFAULT_FACTORS)),
+    )
+    scale_parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    scale_parser.add_argument(
+        "--unsigned", action="store_true", help="do not sign or verify the streams"
+    )
+    scale_parser.add_argument("--json", action="store_true", help="output JSON")
+
+    return parser.parse_args()
+
+
+def main():
+    """Generate a synthetic mirror or measure scaling."""
+    args = parse_args()
+
+    if args.command == "generate":
+        keyring_path = generate(
+            args.path,
+            sign=not args.unsigned,
+            **{dimension: getattr(args, dimension) for dimension in DIMENSIONS}
+        )
+        if keyring_path:
+            print("signed with the key in %s" % keyring_path)
+        return
+
+    results = scale(
+        args.dimension,
+        factors=args.factor or DEFAULT_FACTORS,
+        sign=not args.unsigned,
+        repeat=args.repeat,
+    )
+    if args.json:
+        print(json.dumps(results, sort_keys=True, indent=4))
+    else:
+        report(args.dimension, results)
+
+
+if __name__ == "__main__":
+    main()
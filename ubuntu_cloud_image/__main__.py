@@ -2,36 +2,78 @@
 """Ubuntu Cloud Image main module."""
 
 import argparse
+import importlib.util
+import json
 import logging
+import os
 import sys
 
-from . import image
+from . import client, image
+from .cache import DEFAULT_TTL, Cache
+from .hooks import Profile
+from .streams import DEFAULT_WORKERS, Streams, history_date
+from .watch import DEFAULT_INTERVAL, DEFAULT_JITTER, Watcher
 
-CLOUDS = {
-    "azure": image.Azure,
-    "aws": image.AWS,
-    "aws-cn": image.AWSChina,
-    "aws-govcloud": image.AWSGovCloud,
-    "gce": image.GCE,
-    "kvm": image.KVM,
-    "lxc": image.LXC,
-    "maasv2": image.MAASv2,
-    "maas": image.MAASv3,
-}
+CLOUDS = image.CLOUDS
+HISTORY = client.HISTORY
 
 
-def parse_args():  # pylint: disable=too-many-statements
-    """Set up command-line arguments."""
-    parser = argparse.ArgumentParser("ubuntu-cloud-image")
-    parser.add_argument("--debug", action="store_true", help="additional debug output")
+def add_region_arguments(parser, example, all_regions):
+    """Add the region arguments of a regional cloud subcommand.
+
+    Args:
+        parser: subcommand parser
+        example: example region for the help
+        all_regions: add the --all-regions option, exclusive with regions
+    """
+    if all_regions:
+        parser = parser.add_mutually_exclusive_group()
+    # An empty list default is not taken as a region given with --all-regions.
+    parser.add_argument(
+        "region", nargs="*", default=[], help="cloud region(s) (e.g. %s)" % example
+    )
+    if all_regions:
+        parser.add_argument(
+            "--all-regions", action="store_true", help="latest image of every region"
+        )
+
+
+def date_argument(value):
+    """Check a date of the history options, returning it as YYYYMMDD."""
+    try:
+        return history_date(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def add_history_arguments(parser):
+    """Add the options looking up past serials to a cloud subcommand."""
+    parser.add_argument(
+        "--last", type=int, help="images of the N most recent serials, newest first"
+    )
+    parser.add_argument(
+        "--since",
+        type=date_argument,
+        help="images of serials dated on or after YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "--until",
+        type=date_argument,
+        help="images of serials dated on or before YYYY-MM-DD",
+    )
 
-    subparsers = parser.add_subparsers()
-    subparsers.required = True
-    subparsers.dest = "command"
 
+def add_cloud_parsers(subparsers, all_regions=True, history=True):
+    """Add a subcommand for each cloud.
+
+    Args:
+        subparsers: subparsers action the cloud subcommands are added to
+        all_regions: add the --all-regions option to regional clouds
+        history: add the --last, --since and --until options
+    """
     aws = subparsers.add_parser("aws", help="Amazon Web Services")
     aws.add_argument("release", help="Ubuntu release codename (e.g. Bionic)")
-    aws.add_argument("region", help="cloud region (e.g. us-west-2)")
+    add_region_arguments(aws, "us-west-2", all_regions)
     aws.add_argument("--daily", action="store_true", help="daily image")
     aws.add_argument("--minimal", action="store_true", help="minimal image")
     aws.add_argument(
@@ -49,7 +91,7 @@ def parse_args():  # pylint: disable=too-many-statements
 
     aws_cn = subparsers.add_parser("aws-cn", help="Amazon Web Services China")
     aws_cn.add_argument("release", help="Ubuntu release codename (e.g. Bionic)")
-    aws_cn.add_argument("region", help="cloud region (e.g. cn-north-1)")
+    add_region_arguments(aws_cn, "cn-north-1", all_regions)
     aws_cn.add_argument(
         "--arch",
         default="amd64",
@@ -67,7 +109,7 @@ def parse_args():  # pylint: disable=too-many-statements
         "aws-govcloud", help="Amazon Web Services GovCloud"
     )
     aws_govcloud.add_argument("release", help="Ubuntu release codename (e.g. Bionic)")
-    aws_govcloud.add_argument("region", help="cloud region (e.g. us-gov-west-1)")
+    add_region_arguments(aws_govcloud, "us-gov-west-1", all_regions)
     aws_govcloud.add_argument(
         "--arch",
         default="amd64",
@@ -83,7 +125,7 @@ def parse_args():  # pylint: disable=too-many-statements
 
     azure = subparsers.add_parser("azure", help="Microsoft Azure")
     azure.add_argument("release", help="Ubuntu release codename (e.g. Bionic)")
-    azure.add_argument("region", help="cloud region (e.g. 'West US')")
+    add_region_arguments(azure, "'West US'", all_regions)
     azure.add_argument("--daily", action="store_true", help="daily image")
     azure.add_argument(
         "--arch",
@@ -94,7 +136,7 @@ def parse_args():  # pylint: disable=too-many-statements
 
     gce = subparsers.add_parser("gce", help="Google Compute Engine")
     gce.add_argument("release", help="Ubuntu release codename (e.g. Bionic)")
-    gce.add_argument("region", help="cloud region (e.g. us-west1)")
+    add_region_arguments(gce, "us-west1", all_regions)
     gce.add_argument("--daily", action="store_true", help="daily image")
     gce.add_argument("--minimal", action="store_true", help="minimal image")
     gce.add_argument(
@@ -151,7 +193,197 @@ def parse_args():  # pylint: disable=too-many-statements
         "--kernel", default="generic", help="kernel flavor (default: generic)"
     )
 
-    return parser.parse_args()
+    if history:
+        for cloud in (aws, aws_cn, aws_govcloud, azure, gce, kvm, lxc, maasv2, maasv3):
+            add_history_arguments(cloud)
+
+
+def parse_args():  # pylint: disable=too-many-statements
+    """Set up command-line arguments."""
+    parser = argparse.ArgumentParser("ubuntu-cloud-image")
+    parser.add_argument("--debug", action="store_true", help="additional debug output")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print the time spent in each phase of the lookup to stderr",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=DEFAULT_TTL,
+        type=int,
+        help="seconds to use cached streams before revalidating (default: %s)"
+        % DEFAULT_TTL,
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not use the streams cache"
+    )
+    parser.add_argument(
+        "--workers",
+        default=DEFAULT_WORKERS,
+        type=int,
+        help="product files downloaded concurrently (default: %s)" % DEFAULT_WORKERS,
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="parse product files incrementally, keeping only matching products",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="answer from the local index when it covers the mirror",
+    )
+    parser.add_argument(
+        "--mirror-dir",
+        default=os.getenv("UBUNTU_CLOUD_IMAGE_MIRROR_DIR"),
+        help="read the local copies made by 'mirror sync' in this directory "
+        "instead of the network, still verified with the keyring "
+        "(default: $UBUNTU_CLOUD_IMAGE_MIRROR_DIR)",
+    )
+    parser.add_argument(
+        "--server",
+        default=os.getenv("UBUNTU_CLOUD_IMAGE_SERVER"),
+        help="URL of a running query daemon to ask first "
+        "(default: $UBUNTU_CLOUD_IMAGE_SERVER)",
+    )
+
+    subparsers = parser.add_subparsers()
+    subparsers.required = True
+    subparsers.dest = "command"
+
+    add_cloud_parsers(subparsers)
+
+    all_clouds = subparsers.add_parser(
+        "all", help="latest image of a release on every cloud"
+    )
+    all_clouds.add_argument("release", help="Ubuntu release codename (e.g. Bionic)")
+    all_clouds.add_argument(
+        "--arch",
+        choices=image.Image.arches,
+        help="architecture, clouds without it use their default (default: amd64)",
+    )
+    all_clouds.add_argument(
+        "--region",
+        action="append",
+        default=[],
+        dest="regions",
+        metavar="CLOUD=REGION",
+        help="region of a cloud, may be repeated (default: %s)"
+        % ", ".join(
+            "%s=%s" % (name, region) for name, region in image.DEFAULT_REGIONS.items()
+        ),
+    )
+
+    index = subparsers.add_parser("index", help="local index of streams")
+    index_subparsers = index.add_subparsers()
+    index_subparsers.required = True
+    index_subparsers.dest = "action"
+    index_build = index_subparsers.add_parser(
+        "build", help="index mirrors, skipping those that did not change"
+    )
+    index_build.add_argument(
+        "--mirror",
+        action="append",
+        help="mirror URL to index, may be repeated (default: all known mirrors)",
+    )
+    index_build.add_argument(
+        "--force", action="store_true", help="rebuild even if a mirror did not change"
+    )
+
+    mirror = subparsers.add_parser("mirror", help="local copies of the streams")
+    mirror_subparsers = mirror.add_subparsers()
+    mirror_subparsers.required = True
+    mirror_subparsers.dest = "action"
+    mirror_sync = mirror_subparsers.add_parser(
+        "sync", help="copy and verify the signed streams of mirrors into a directory"
+    )
+    mirror_sync.add_argument("directory", help="directory to copy the mirrors to")
+    mirror_sync.add_argument(
+        "--mirror",
+        action="append",
+        help="mirror URL to copy, may be repeated (default: all known mirrors)",
+    )
+
+    serve = subparsers.add_parser(
+        "serve", help="run a query daemon with a warm in-memory catalogue"
+    )
+    serve.add_argument(
+        "--host",
+        default=client.DEFAULT_HOST,
+        help="address to listen on (default: %s)" % client.DEFAULT_HOST,
+    )
+    serve.add_argument(
+        "--port",
+        default=client.DEFAULT_PORT,
+        type=int,
+        help="port to listen on (default: %s)" % client.DEFAULT_PORT,
+    )
+    serve.add_argument(
+        "--refresh",
+        default=client.DEFAULT_REFRESH,
+        type=int,
+        help="seconds between catalogue refreshes (default: %s)"
+        % client.DEFAULT_REFRESH,
+    )
+
+    batch = subparsers.add_parser(
+        "batch", help="look up a list of queries, printing NDJSON results"
+    )
+    batch.add_argument(
+        "queries",
+        nargs="?",
+        default="-",
+        help="JSON, NDJSON or YAML file of queries (default: stdin)",
+    )
+
+    watch = subparsers.add_parser(
+        "watch", help="poll a cloud, printing a line for each new serial"
+    )
+    watch.add_argument(
+        "--interval",
+        default=DEFAULT_INTERVAL,
+        type=int,
+        help="seconds between polls (default: %s)" % DEFAULT_INTERVAL,
+    )
+    watch.add_argument(
+        "--jitter",
+        default=DEFAULT_JITTER,
+        type=int,
+        help="maximum random seconds added to each interval (default: %s)"
+        % DEFAULT_JITTER,
+    )
+    watch_subparsers = watch.add_subparsers()
+    watch_subparsers.required = True
+    watch_subparsers.dest = "cloud"
+    add_cloud_parsers(watch_subparsers, all_regions=False, history=False)
+
+    args = parser.parse_args()
+    if args.command == "batch" and args.queries.endswith((".yaml", ".yml")):
+        if importlib.util.find_spec("yaml") is None:
+            parser.error("reading YAML queries requires PyYAML (pip install pyyaml)")
+    if getattr(args, "region", None) == []:
+        if args.command == "watch":
+            parser.error("a region is required")
+        if not args.all_regions:
+            parser.error("a region or --all-regions is required")
+    if args.command == "all":
+        for region in args.regions:
+            (name, sep, _) = region.partition("=")
+            if not sep or name not in image.DEFAULT_REGIONS:
+                parser.error(
+                    "--region must be CLOUD=REGION with CLOUD one of %s"
+                    % ", ".join(image.DEFAULT_REGIONS)
+                )
+    (last, since, until) = (getattr(args, key, None) for key in HISTORY)
+    if last is not None and last < 1:
+        parser.error("--last must be at least 1")
+    regions = getattr(args, "region", None) or []
+    if (last is not None or since or until) and (
+        getattr(args, "all_regions", False) or len(regions) > 1
+    ):
+        parser.error("--last, --since and --until take a single region")
+
+    return args
 
 
 def setup_logging(debug):
@@ -168,11 +400,283 @@ def setup_logging(debug):
 def launch():
     """Launch ubuntu-cloud-image."""
     cli = vars(parse_args())
-    log = setup_logging(cli.pop("debug"))
+    setup_logging(cli.pop("debug"))
+
+    cache_ttl = cli.pop("cache_ttl")
+    if cli["command"] == "watch":
+        # Every poll revalidates the index with a conditional request.
+        cache_ttl = 0
+    streams_args = {
+        "cache": None if cli.pop("no_cache") else Cache(ttl=cache_ttl),
+        "workers": cli.pop("workers"),
+        "streaming": cli.pop("low_memory"),
+    }
+    mirror_dir = cli.pop("mirror_dir")
+    if mirror_dir and cli["command"] != "mirror":
+        streams_args["mirror_dir"] = mirror_dir
+    index = None
+    if cli.pop("index"):
+        from .index import Index  # pylint: disable=import-outside-toplevel
+
+        index = Index()
+    server_url = cli.pop("server")
+
+    profile = Profile() if cli.pop("profile") else None
+    if not profile:
+        run_command(cli, streams_args, index, server_url)
+        return
+
+    import tracemalloc  # pylint: disable=import-outside-toplevel
+
+    streams_args["hooks"] = profile
+    tracemalloc.start()
+    try:
+        run_command(cli, streams_args, index, server_url)
+    finally:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(profile.report(peak_memory), file=sys.stderr)
+
+
+def run_command(cli, streams_args, index, server_url):
+    """Run the subcommand of the command-line arguments.
+
+    Args:
+        cli: dictionary of the remaining command-line arguments
+        streams_args: arguments passed to Streams
+        index: optional Index to answer from
+        server_url: optional URL of a query daemon to ask first
+    """
+    log = logging.getLogger(__name__)
 
-    cloud = CLOUDS[cli.pop("command")](**cli)
+    command = cli.pop("command")
+    if command == "index":
+        build_index(cli["mirror"] or image.MIRRORS, cli["force"], streams_args)
+        return
+    if command == "mirror":
+        sync_mirrors(cli["mirror"] or image.MIRRORS, cli["directory"], streams_args)
+        return
+    if command == "serve":
+        from . import server  # pylint: disable=import-outside-toplevel
+
+        server.serve(cli["host"], cli["port"], cli["refresh"], **streams_args)
+        return
+    if command == "batch":
+        run_batch(cli["queries"], streams_args)
+        return
+    if command == "watch":
+        run_watch(cli, streams_args)
+        return
+
+    if server_url:
+        args = dict(cli)
+        if command == "all":
+            args["region"] = args.pop("regions")
+        try:
+            result = client.query(server_url, command, args)
+        except OSError as error:
+            log.debug("query daemon unavailable: %s", error)
+        else:
+            log.info(json.dumps(result, sort_keys=True, indent=4))
+            return
+
+    if command == "all":
+        regions = dict(region.partition("=")[::2] for region in cli["regions"])
+        result = image.search_all(cli["release"], cli["arch"], regions, **streams_args)
+        log.info(json.dumps(result, sort_keys=True, indent=4))
+        return
+
+    history = {key: cli.pop(key, None) for key in HISTORY}
+    regions = cli.pop("region", None)
+    if cli.pop("all_regions", False) or regions and len(regions) > 1:
+        cloud = CLOUDS[command](region=None, **cli)
+        log.debug(cloud)
+        cloud.search_regions(regions if len(regions) > 1 else None, **streams_args)
+        return
+    if regions:
+        cli["region"] = regions[0]
+
+    if history["last"] is not None or history["since"] or history["until"]:
+        cloud = CLOUDS[command](**cli)
+        log.debug(cloud)
+        cloud.history(**history, **streams_args)
+        return
+
+    cloud = CLOUDS[command](**cli)
     log.debug(cloud)
-    cloud.search()
+    cloud.search(index=index, **streams_args)
+
+
+def read_queries(path):
+    """Read batch queries from a file or stdin.
+
+    Queries are dictionaries with a "cloud" key and the arguments of the
+    cloud subcommand, e.g. {"cloud": "aws", "release": "focal", "region":
+    "us-east-1"}. The file is a JSON or YAML list of queries, or NDJSON
+    with one query per line, each line decoded on its own so an invalid
+    line is reported without losing the others.
+
+    Args:
+        path: path of the file or - for stdin
+
+    Returns:
+        list of (query, error) tuples, error being None unless the query
+        could not be decoded, then query is its raw text
+
+    """
+    if path == "-":
+        content = sys.stdin.read()
+    else:
+        with open(path, "r") as queries_file:
+            content = queries_file.read()
+
+    if path.endswith((".yaml", ".yml")):
+        import yaml  # pylint: disable=import-outside-toplevel
+
+        try:
+            queries = yaml.safe_load(content) or []
+        except yaml.YAMLError as error:
+            return [(content, "invalid YAML: %s" % error)]
+    elif content.lstrip().startswith("["):
+        try:
+            queries = json.loads(content)
+        except ValueError as error:
+            return [(content, "invalid JSON: %s" % error)]
+    else:
+        queries = []
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            try:
+                queries.append((json.loads(line), None))
+            except ValueError as error:
+                queries.append((line, "invalid JSON: %s" % error))
+        return queries
+
+    if not isinstance(queries, list):
+        queries = [queries]
+
+    return [(query, None) for query in queries]
+
+
+def image_from_query(query):
+    """Create the Image of a batch query.
+
+    Args:
+        query: dictionary with the cloud name and its arguments
+
+    Returns:
+        Image instance
+
+    Raises:
+        KeyError: when the cloud is unknown or missing
+        TypeError: when the arguments do not match the cloud
+        ValueError: when the query is not a dictionary
+
+    """
+    if not isinstance(query, dict):
+        raise ValueError("expected an object, got %s" % type(query).__name__)
+
+    args = dict(query)
+
+    return image.image_from_query(args.pop("cloud"), args)
+
+
+def run_batch(path, streams_args):
+    """Look up every query of a batch, printing one NDJSON line each.
+
+    Queries are grouped by mirror so each mirror syncs once, and results
+    are printed as soon as their mirror is synced. A mirror failing to
+    sync is reported for its queries without stopping the batch.
+
+    Args:
+        path: path of the queries file or - for stdin
+        streams_args: arguments passed to Streams
+    """
+    log = logging.getLogger(__name__)
+
+    groups = {}
+    for query, error in read_queries(path):
+        cloud = None
+        if error is None:
+            try:
+                cloud = image_from_query(query)
+            except (AttributeError, KeyError, TypeError, ValueError) as exception:
+                error = "invalid query: %s" % exception
+        if cloud is None:
+            log.info(json.dumps({"query": query, "error": error}, sort_keys=True))
+            continue
+        groups.setdefault(cloud.mirror_url, []).append((query, cloud))
+
+    for group in groups.values():
+        results = image.search_many([cloud for _, cloud in group], **streams_args)
+        for (query, _), result in zip(group, results):
+            if "error" in result:
+                line = {"query": query, "error": result["error"]}
+            else:
+                line = {"query": query, "result": result}
+            log.info(json.dumps(line, sort_keys=True))
+
+
+def run_watch(cli, streams_args):
+    """Watch the images of a cloud, printing one JSON line per new serial.
+
+    Args:
+        cli: dictionary of the watch command-line arguments
+        streams_args: arguments passed to Streams
+    """
+    log = logging.getLogger(__name__)
+
+    interval = cli.pop("interval")
+    jitter = cli.pop("jitter")
+    cloud = CLOUDS[cli.pop("cloud")]
+    regions = cli.pop("region", None)
+    if regions:
+        images = [cloud(region=region, **cli) for region in regions]
+    else:
+        images = [cloud(**cli)]
+
+    watcher = Watcher(images, interval, jitter, **streams_args)
+    try:
+        watcher.run(lambda event: log.info(json.dumps(event, sort_keys=True)))
+    except KeyboardInterrupt:
+        pass
+
+
+def sync_mirrors(mirrors, directory, streams_args):
+    """Copy the signed streams of the given mirrors into a directory.
+
+    Args:
+        mirrors: list of mirror URLs to copy
+        directory: directory of the local copies
+        streams_args: arguments passed to Streams
+    """
+    log = logging.getLogger(__name__)
+    for mirror_url in mirrors:
+        stream = Streams(mirror_url, image.default_keyring_path(), **streams_args)
+        copied = stream.snapshot(directory)
+        log.info("copied %s product files of %s", copied, mirror_url)
+
+
+def build_index(mirrors, force, streams_args):
+    """Build the local index of the given mirrors.
+
+    Args:
+        mirrors: list of mirror URLs to index
+        force: rebuild even if a mirror did not change
+        streams_args: arguments passed to Streams
+    """
+    from .index import Index  # pylint: disable=import-outside-toplevel
+
+    log = logging.getLogger(__name__)
+    index = Index()
+    for mirror_url in mirrors:
+        if index.build(
+            mirror_url, image.default_keyring_path(), force=force, **streams_args
+        ):
+            log.info("indexed %s", mirror_url)
+        else:
+            log.info("%s is up to date", mirror_url)
 
 
 if __name__ == "__main__":
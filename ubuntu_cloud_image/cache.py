@@ -0,0 +1,503 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Persistent on-disk cache for streams metadata."""
+
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import logging
+import marshal
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+DEFAULT_TTL = 600
+
+CHUNK_SIZE = 64 * 1024
+COMPRESS_LEVEL = 6
+
+POOL_SIZE = 16
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def cache_dir():
+    """Determine the directory used to store cached streams data.
+
+    Under the snap this is $SNAP_USER_COMMON, otherwise the XDG cache
+    directory is used.
+
+    Returns:
+        path to the cache directory
+
+    """
+    snap_common = os.getenv("SNAP_USER_COMMON")
+    if snap_common:
+        return os.path.join(snap_common, "cache")
+
+    xdg_cache = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(xdg_cache, "ubuntu-cloud-image")
+
+
+def keyring_identity(keyring_path):
+    """Return a string identifying a keyring and its last modification.
+
+    Verifications made against a keyring are only trusted while this
+    identity is unchanged.
+
+    Raises:
+        OSError: when the keyring cannot be read
+
+    """
+    return "%s\0%s" % (keyring_path, os.stat(keyring_path).st_mtime_ns)
+
+
+def write_file(path, content):
+    """Atomically replace path with content, creating its directory."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections reused for the requests to a host.
+
+    urlopen opens a new connection, and TLS session, for every file; the
+    pool keeps them open so the index and product files of a mirror, and
+    concurrent lookups, share a few connections. A connection serves one
+    request at a time, concurrent requests opening more as needed.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        """Initialize ConnectionPool class.
+
+        Args:
+            size: idle connections kept open per host
+        """
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, host):
+        """Return an idle connection to a host, or a new one.
+
+        Returns:
+            tuple of the connection and whether it was reused
+
+        """
+        import http.client  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(host), False
+        return http.client.HTTPConnection(host), False
+
+    def _release(self, scheme, host, connection, response):
+        """Keep a connection whose response was read, unless it closes."""
+        if not response.will_close:
+            with self._lock:
+                idle = self._idle.setdefault((scheme, host), [])
+                if len(idle) < self.size:
+                    idle.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            (idle, self._idle) = (self._idle, {})
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, scheme, host, selector, headers):
+        """Send a GET request and return the response and its connection.
+
+        A kept-alive connection may have been closed by the server since
+        its last request, the request is then sent again on another one.
+        """
+        import http.client  # pylint: disable=import-outside-toplevel
+
+        while True:
+            (connection, reused) = self._connection(scheme, host)
+            try:
+                connection.request("GET", selector, headers=headers)
+                return connection.getresponse(), connection
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+
+    @contextlib.contextmanager
+    def open(self, request):
+        """Send a request over a kept-alive connection to its host.
+
+        Like urlopen, redirects are followed and error statuses raised.
+
+        Args:
+            request: urllib Request of an http(s) URL
+
+        Yields:
+            http.client.HTTPResponse, its connection being returned to the
+            pool once the body was read
+
+        Raises:
+            urllib.error.HTTPError: when the server answers with an error
+                or not modified status
+
+        """
+        import urllib.error  # pylint: disable=import-outside-toplevel
+        import urllib.parse  # pylint: disable=import-outside-toplevel
+
+        url = request.full_url
+        headers = dict(request.header_items())
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            selector = urllib.parse.urlunsplit(
+                ("", "", parts.path or "/", parts.query, "")
+            )
+            (response, connection) = self._request(
+                parts.scheme, parts.netloc, selector, headers
+            )
+            if response.status < 300:
+                break
+
+            body = response.read()
+            self._release(parts.scheme, parts.netloc, connection, response)
+            location = response.getheader("Location")
+            if response.status in REDIRECT_CODES and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            raise urllib.error.HTTPError(
+                url,
+                response.status,
+                response.reason,
+                response.headers,
+                io.BytesIO(body),
+            )
+        else:
+            raise urllib.error.HTTPError(
+                url, response.status, "too many redirects", response.headers, None
+            )
+
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        self._release(parts.scheme, parts.netloc, connection, response)
+
+
+POOL = ConnectionPool()
+
+
+def download(request, hooks=None, keep_encoded=False):
+    """Open a URL or Request and read the response.
+
+    HTTP servers are asked for gzip compressed content, which is
+    decompressed while it is read, over the kept-alive connections of
+    POOL unless a proxy is configured.
+
+    Args:
+        request: URL or urllib Request
+        hooks: optional Hooks notified of the transfer
+        keep_encoded: also return the compressed body
+
+    Returns:
+        tuple of the response headers, the content and the gzip body as
+        received (None if not compressed or not kept)
+
+    """
+    import urllib.request  # pylint: disable=import-outside-toplevel
+
+    if isinstance(request, str):
+        request = urllib.request.Request(request)
+    opener = urllib.request.urlopen
+    if request.type in ("http", "https"):
+        request.add_header("Accept-Encoding", "gzip")
+        proxies = urllib.request.getproxies()
+        if request.type not in proxies or urllib.request.proxy_bypass(request.host):
+            opener = POOL.open
+
+    start = time.perf_counter()
+    with opener(request) as response:
+        connected = time.perf_counter()
+        decompressor = None
+        if response.headers.get("Content-Encoding") == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        size = 0
+        chunks = []
+        encoded_chunks = []
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+            size += len(chunk)
+            if decompressor:
+                if keep_encoded:
+                    encoded_chunks.append(chunk)
+                chunk = decompressor.decompress(chunk)
+            chunks.append(chunk)
+        if decompressor:
+            chunks.append(decompressor.flush())
+
+    if hooks:
+        hooks.phase("connect", request.full_url, connected - start)
+        hooks.phase("download", request.full_url, time.perf_counter() - connected)
+        hooks.transferred(request.full_url, size)
+
+    encoded = b"".join(encoded_chunks) if decompressor and keep_encoded else None
+    return response.headers, b"".join(chunks), encoded
+
+
+class Cache:
+    """On-disk cache of downloaded streams files.
+
+    Each URL is stored as a pair of files: the gzip compressed body and
+    a small JSON document with the ETag and Last-Modified headers returned
+    by the server. Entries younger than the TTL are served without any network
+    access, older entries are revalidated with a conditional request.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        """Initialize Cache class.
+
+        Args:
+            path: directory to store cache entries (default: cache_dir())
+            ttl: seconds an entry is used without revalidation
+        """
+        self._log = logging.getLogger(__name__)
+
+        self.path = path or cache_dir()
+        self.ttl = ttl
+
+    def _entry_path(self, url):
+        """Return the base path of the entry for a URL."""
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key)
+
+    def _load_meta(self, entry):
+        """Read the metadata of an entry, None if missing or corrupt."""
+        try:
+            with open("%s.json" % entry, "r") as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def _read(self, entry, meta):
+        """Read the cached body of an entry, None if missing or corrupt."""
+        try:
+            with open("%s.data" % entry, "rb") as data_file:
+                content = data_file.read()
+            if meta.get("encoding") == "gzip":
+                content = gzip.decompress(content)
+        except (OSError, EOFError, zlib.error):
+            return None
+
+        return content
+
+    def _store(self, entry, meta, content=None):
+        """Store the metadata and, if given, the body of an entry.
+
+        Failing to write the cache is not fatal, the caller still has
+        the content in hand.
+        """
+        try:
+            if content is not None:
+                write_file("%s.data" % entry, content)
+            write_file("%s.json" % entry, json.dumps(meta).encode("utf-8"))
+        except OSError as error:
+            self._log.debug("unable to write cache entry %s: %s", entry, error)
+
+    def fetch(self, url, hooks=None):
+        """Return the content of a URL, reading through the cache.
+
+        Args:
+            url: URL to fetch, only http(s) URLs are cached
+            hooks: optional Hooks notified of network transfers
+
+        Returns:
+            bytes of the content
+
+        """
+        if not url.startswith(("http://", "https://")):
+            return download(url, hooks)[1]
+
+        entry = self._entry_path(url)
+        meta = self._load_meta(entry)
+        content = self._read(entry, meta) if meta else None
+
+        if content is not None and time.time() - meta["checked"] < self.ttl:
+            self._log.debug("cache hit: %s", url)
+            return content
+
+        # Only needed on network access, kept out of the CLI start up.
+        import urllib.error  # pylint: disable=import-outside-toplevel
+        import urllib.request  # pylint: disable=import-outside-toplevel
+
+        request = urllib.request.Request(url)
+        if content is not None:
+            if meta.get("etag"):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                request.add_header("If-Modified-Since", meta["last_modified"])
+
+        try:
+            (headers, content, encoded) = download(request, hooks, keep_encoded=True)
+        except urllib.error.HTTPError as error:
+            if error.code != 304 or content is None:
+                raise
+            self._log.debug("cache revalidated: %s", url)
+            meta["checked"] = time.time()
+            self._store(entry, meta)
+            return content
+
+        self._log.debug("cache miss: %s", url)
+        if encoded is None:
+            encoded = gzip.compress(content, compresslevel=COMPRESS_LEVEL)
+        self._store(
+            entry,
+            {
+                "url": url,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "checked": time.time(),
+                "encoding": "gzip",
+            },
+            encoded,
+        )
+
+        return content
+
+    def _result_path(self, key):
+        """Return the path of the stored result of a query."""
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "results", "%s.json" % digest)
+
+    def load_result(self, key):
+        """Return the result of a query stored less than the TTL ago.
+
+        Args:
+            key: string identifying the query
+
+        Returns:
+            result or None if missing or stale
+
+        """
+        try:
+            with open(self._result_path(key), "r") as result_file:
+                stored = json.load(result_file)
+        except (OSError, ValueError):
+            return None
+
+        if stored.get("key") != key or time.time() - stored["checked"] >= self.ttl:
+            return None
+
+        self._log.debug("result cache hit")
+        return stored["result"]
+
+    def store_result(self, key, result):
+        """Store the result of a query.
+
+        Args:
+            key: string identifying the query
+            result: JSON serializable result
+        """
+        content = json.dumps({"key": key, "checked": time.time(), "result": result})
+        try:
+            write_file(self._result_path(key), content.encode("utf-8"))
+        except OSError as error:
+            self._log.debug("unable to store result: %s", error)
+
+    def load_document(self, url, tag):
+        """Return the parsed document stored for a URL.
+
+        Args:
+            url: URL the document was read from
+            tag: value identifying the version of the document, e.g. the
+                updated timestamp of its index entry
+
+        Returns:
+            parsed document or None if missing or stored with another tag
+
+        """
+        try:
+            with open("%s.parsed" % self._entry_path(url), "rb") as parsed_file:
+                content = zlib.decompress(parsed_file.read())
+            (version, stored_tag, data) = marshal.loads(content)
+        except (OSError, EOFError, ValueError, TypeError, zlib.error):
+            return None
+
+        if version != marshal.version or stored_tag != tag:
+            return None
+
+        self._log.debug("parsed document hit: %s", url)
+        return data
+
+    def store_document(self, url, tag, data):
+        """Store the parsed document of a URL.
+
+        The document is serialized with marshal, and lightly compressed,
+        so loading it again is cheaper than parsing and verifying the
+        signed file.
+
+        Args:
+            url: URL the document was read from
+            tag: value identifying the version of the document
+            data: parsed document
+        """
+        try:
+            content = zlib.compress(marshal.dumps((marshal.version, tag, data)), 1)
+            write_file("%s.parsed" % self._entry_path(url), content)
+        except (OSError, ValueError) as error:
+            self._log.debug("unable to store parsed document %s: %s", url, error)
+
+    def _verified_path(self, content, keyring_path):
+        """Return the marker path for content verified against a keyring.
+
+        The key covers the keyring path and mtime so that any change to
+        the keyring invalidates previous verifications.
+        """
+        digest = hashlib.sha256(content.encode("utf-8"))
+        digest.update(("\0%s" % keyring_identity(keyring_path)).encode("utf-8"))
+        return os.path.join(self.path, "verified", digest.hexdigest())
+
+    def is_verified(self, content, keyring_path):
+        """Check if signed content was already verified with a keyring.
+
+        Args:
+            content: signed content
+            keyring_path: keyring the content was verified with
+
+        Returns:
+            True if the content was verified before
+
+        """
+        try:
+            return os.path.exists(self._verified_path(content, keyring_path))
+        except OSError:
+            return False
+
+    def set_verified(self, content, keyring_path):
+        """Record that signed content was verified with a keyring.
+
+        Args:
+            content: signed content
+            keyring_path: keyring the content was verified with
+        """
+        try:
+            write_file(self._verified_path(content, keyring_path), b"")
+        except OSError as error:
+            self._log.debug("unable to record verification: %s", error)
@@ -0,0 +1,52 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Client of the query daemon and the settings shared with it.
+
+Kept apart from the server module so the CLI can ask a daemon without
+importing the HTTP server.
+"""
+
+import json
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8008
+DEFAULT_REFRESH = 600
+
+FLAGS = ("daily", "minimal", "all_regions")
+HISTORY = ("last", "since", "until")
+
+
+def query(server_url, command, args, timeout=30):
+    """Ask a running daemon for the images of a cloud, or of every cloud.
+
+    Args:
+        server_url: base URL of the daemon (e.g. http://127.0.0.1:8008)
+        command: cloud name as used by the CLI (e.g. aws) or all
+        args: dictionary of the command arguments, region being a list
+            when several regions are looked up
+        timeout: seconds to wait for the daemon
+
+    Returns:
+        result of the lookup, as printed by the matching CLI command
+
+    Raises:
+        OSError: when the daemon cannot be reached or fails
+
+    """
+    import urllib.parse  # pylint: disable=import-outside-toplevel
+    import urllib.request  # pylint: disable=import-outside-toplevel
+
+    params = {}
+    for key, value in args.items():
+        if key in FLAGS:
+            if value:
+                params[key] = "1"
+        elif value is not None:
+            params[key] = value
+
+    url = "%s/%s?%s" % (
+        server_url.rstrip("/"),
+        command,
+        urllib.parse.urlencode(params, doseq=True),
+    )
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
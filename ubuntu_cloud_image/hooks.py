@@ -0,0 +1,111 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Hooks notified of the work done by streams queries."""
+
+import collections
+import threading
+
+PHASES = ("connect", "download", "verify", "parse", "filter", "expand")
+COLUMNS = PHASES + ("bytes", "examined", "matched")
+
+
+class Hooks:
+    """Callbacks called by Streams while it queries a mirror.
+
+    Every method does nothing, subclasses override those they need.
+    Product files may be read concurrently, so hooks can be called from
+    several threads at once.
+    """
+
+    def phase(self, name, url, seconds):
+        """Report the time spent in a phase for a file.
+
+        Args:
+            name: one of PHASES
+            url: URL of the index or product file
+            seconds: time spent
+        """
+
+    def transferred(self, url, size):
+        """Report bytes downloaded from the network.
+
+        Args:
+            url: URL of the index or product file
+            size: number of bytes read
+        """
+
+    def items(self, url, examined, matched):
+        """Report the items of a product file checked against the filters.
+
+        Args:
+            url: URL of the product file
+            examined: number of items checked
+            matched: number of items matching a filter
+        """
+
+
+class Profile(Hooks):
+    """Hooks collecting a per file breakdown of a query."""
+
+    def __init__(self):
+        """Initialize Profile class."""
+        self.files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _file(self, url):
+        """Return the counters of a file, creating them on first use."""
+        if url not in self.files:
+            self.files[url] = dict.fromkeys(COLUMNS, 0)
+
+        return self.files[url]
+
+    def phase(self, name, url, seconds):
+        """Add the time spent in a phase."""
+        with self._lock:
+            self._file(url)[name] += seconds
+
+    def transferred(self, url, size):
+        """Add bytes downloaded."""
+        with self._lock:
+            self._file(url)["bytes"] += size
+
+    def items(self, url, examined, matched):
+        """Add items examined and matched."""
+        with self._lock:
+            counters = self._file(url)
+            counters["examined"] += examined
+            counters["matched"] += matched
+
+    def report(self, peak_memory=None):
+        """Format the breakdown as a table.
+
+        Args:
+            peak_memory: optional peak of traced memory in bytes
+
+        Returns:
+            report as a string
+
+        """
+        lines = ["%-40s %s" % ("file", " ".join("%10s" % column for column in COLUMNS))]
+
+        totals = dict.fromkeys(COLUMNS, 0)
+        for url, counters in self.files.items():
+            lines.append(self._row(url.rpartition("/")[2], counters))
+            for column in COLUMNS:
+                totals[column] += counters[column]
+        lines.append(self._row("total", totals))
+
+        if peak_memory is not None:
+            lines.append("peak memory: %d KiB" % (peak_memory // 1024))
+
+        return "\n".join(lines)
+
+    @staticmethod
+    def _row(name, counters):
+        """Format the counters of a file."""
+        return "%-40s %s %10d %10d %10d" % (
+            name[-40:],
+            " ".join("%10.3f" % counters[phase] for phase in PHASES),
+            counters["bytes"],
+            counters["examined"],
+            counters["matched"],
+        )
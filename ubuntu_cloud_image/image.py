@@ -1,17 +1,44 @@
 # This file is part of ubuntu-cloud-image. See LICENSE for license information.
 """Ubuntu Cloud Image class."""
 
+import concurrent.futures
+import inspect
 import json
 import logging
 import os
+import re
 
+from .client import FLAGS
 from .streams import Streams
 
+MIRRORS = [
+    "https://cloud-images.ubuntu.com/releases/",
+    "https://cloud-images.ubuntu.com/daily/",
+    "https://cloud-images.ubuntu.com/minimal/releases/",
+    "https://cloud-images.ubuntu.com/minimal/daily/",
+    "https://images.maas.io/ephemeral-v2/releases/",
+    "https://images.maas.io/ephemeral-v2/daily/",
+    "https://images.maas.io/ephemeral-v3/daily/",
+]
+
+
+def default_keyring_path():
+    """Path to the keyring used to verify streams content."""
+    keyring_path = "/usr/share/keyrings/ubuntu-cloudimage-keyring.gpg"
+    snap = os.getenv("SNAP")
+    if snap:
+        keyring_path = "%s%s" % (snap, keyring_path)
+
+    return keyring_path
+
 
 class Image:
     """Base cloud image to set default mirror URL and keyring."""
 
     name = "unknown"
+    content_id = None
+    # Architectures of the images, the first one being the default.
+    arches = ("amd64", "arm64", "ppc64el", "s390x", "armhf", "i386")
 
     def __init__(self, release, arch, daily=False, minimal=False):
         """Initialize base image."""
@@ -39,6 +66,23 @@ class Image:
         """Create filter."""
         return []
 
+    @property
+    def index_filter(self):
+        """Create filter for the streams index.
+
+        Limits the product files read to those whose content_id ends with
+        the content_id of the class (e.g. com.ubuntu.cloud:released:aws).
+        """
+        if not self.content_id:
+            return []
+
+        return ["content_id~:%s$" % self.content_id]
+
+    @property
+    def regional_filter(self):
+        """Create filter matching the image in any region."""
+        return [item for item in self.filter if not item.startswith("region=")]
+
     def _mirror_url(self):
         """Create mirror URL baed on filter settings."""
         mirror_base_url = "https://cloud-images.ubuntu.com"
@@ -54,9 +98,20 @@ class Image:
 
         return "%s/releases/" % mirror_base_url
 
-    def search(self):
+    @property
+    def keyring_path(self):
+        """Path to the keyring used to verify streams content."""
+        return default_keyring_path()
+
+    def search(self, index=None, **kwargs):
         """Find list of images with the setup filter.
 
+        Args:
+            index: optional Index to answer from when it covers the mirror
+                as of its current streams index, the streams being queried
+                with a warning when it is out of date
+            kwargs: additional arguments passed to Streams (e.g. cache)
+
         Returns:
             dictionary of discovered image
 
@@ -64,29 +119,175 @@ class Image:
             SystemExit: when no results found
 
         """
-        keyring_path = "/usr/share/keyrings/ubuntu-cloudimage-keyring.gpg"
-        snap = os.getenv("SNAP")
-        if snap:
-            keyring_path = "%s%s" % (snap, keyring_path)
+        result = None
+        if index and index.has_mirror(self.mirror_url):
+            if index.is_current(self.mirror_url, self.keyring_path, **kwargs):
+                result = index.search(self)
+            else:
+                self._log.warning(
+                    "index of %s is out of date, querying the streams instead "
+                    "(run ubuntu-cloud-image index build to update it)",
+                    self.mirror_url,
+                )
+
+        if result is None:
+            stream = Streams(
+                mirror_url=self.mirror_url, keyring_path=self.keyring_path, **kwargs
+            )
+
+            try:
+                matches = stream.query(self.filter, self.index_filter, latest_only=True)
+                result = matches[0]
+            except IndexError:
+                result = {}
+
+        self._log.info(json.dumps(result, sort_keys=True, indent=4))
 
-        stream = Streams(mirror_url=self.mirror_url, keyring_path=keyring_path)
+        return result
 
-        try:
-            result = stream.query(self.filter)[0]
-        except IndexError:
-            result = {}
+    def history(self, last=None, since=None, until=None, **kwargs):
+        """Find the images of the last serials or of a date range.
+
+        Args:
+            last: number of most recent serials to return
+            since: only return serials dated on or after this date
+                (YYYYMMDD or YYYY-MM-DD)
+            until: only return serials dated on or before this date
+                (YYYYMMDD or YYYY-MM-DD)
+            kwargs: additional arguments passed to Streams (e.g. cache)
+
+        Returns:
+            list of discovered images, newest first
+
+        """
+        stream = Streams(
+            mirror_url=self.mirror_url, keyring_path=self.keyring_path, **kwargs
+        )
+        result = stream.query(
+            self.filter, self.index_filter, last=last, since=since, until=until
+        )
 
         self._log.info(json.dumps(result, sort_keys=True, indent=4))
 
+        return result
+
+    def search_regions(self, regions=None, **kwargs):
+        """Find the latest image of every region with a single sync.
+
+        Args:
+            regions: list of regions to limit to (default: all regions)
+            kwargs: additional arguments passed to Streams (e.g. cache)
+
+        Returns:
+            dictionary of region to discovered image
+
+        """
+        img_filter = self.regional_filter
+        if regions:
+            img_filter.append(
+                "region~^(%s)$" % "|".join(re.escape(region) for region in regions)
+            )
+
+        stream = Streams(
+            mirror_url=self.mirror_url, keyring_path=self.keyring_path, **kwargs
+        )
+        groups = stream.query(img_filter, self.index_filter, group_by="region")
+        result = {region: entries[0] for region, entries in groups.items() if region}
+
+        self._log.info(json.dumps(result, sort_keys=True, indent=4))
+
+        return result
+
+    async def asearch(self, **kwargs):
+        """Find the latest image without blocking the event loop.
+
+        Args:
+            kwargs: additional arguments passed to Streams (e.g. cache)
+
+        Returns:
+            dictionary of discovered image or empty
+
+        """
+        stream = Streams(
+            mirror_url=self.mirror_url, keyring_path=self.keyring_path, **kwargs
+        )
+
+        matches = await stream.aquery(self.filter, self.index_filter, latest_only=True)
+
+        return matches[0] if matches else {}
+
+
+def search_many(images, **kwargs):
+    """Find the latest image for many images at once.
+
+    Images are grouped by mirror URL so each mirror is only synced once
+    no matter how many images are looked up on it, and the mirrors are
+    synced concurrently. A mirror failing to sync is logged and does not
+    stop the lookups on the other mirrors.
+
+    Args:
+        images: list of Image instances
+        kwargs: additional arguments passed to Streams (e.g. cache)
+
+    Returns:
+        list of discovered images, in the same order as images, with an
+        empty dictionary for images without a match and a dictionary with
+        the error for images of a mirror that failed to sync
+
+    """
+    groups = {}
+    for position, image in enumerate(images):
+        key = (image.mirror_url, image.keyring_path)
+        groups.setdefault(key, []).append(position)
+
+    def search_group(group):
+        ((mirror_url, keyring_path), positions) = group
+        stream = Streams(mirror_url=mirror_url, keyring_path=keyring_path, **kwargs)
+        try:
+            matches = stream.query_many(
+                [images[position].filter for position in positions],
+                [images[position].index_filter for position in positions],
+                latest_only=True,
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            logging.getLogger(__name__).warning(
+                "sync of %s failed: %s", mirror_url, error
+            )
+            return [{"error": "%s: %s" % (mirror_url, error)}] * len(positions)
+
+        return [match[0] if match else {} for match in matches]
+
+    results = [{}] * len(images)
+    if not groups:
+        return results
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as pool:
+        for positions, matches in zip(
+            groups.values(), pool.map(search_group, groups.items())
+        ):
+            for position, match in zip(positions, matches):
+                results[position] = match
+
+    return results
+
 
 # pylint: disable=C0330
 class AWS(Image):
     """AWS class."""
 
     name = "AWS"
+    content_id = "aws"
+    arches = ("amd64", "arm64")
+    endpoint = "https://ec2.%s.amazonaws.com"
 
     def __init__(
-        self, release, arch, region, root_store="ssd", daily=False, minimal=False,
+        self,
+        release,
+        arch,
+        region,
+        root_store="ssd",
+        daily=False,
+        minimal=False,
     ):
         """Initialize AWS instance.
 
@@ -119,54 +320,50 @@ class AWS(Image):
         """Create filter."""
         return [
             "arch=%s" % self.arch,
-            "endpoint=https://ec2.%s.amazonaws.com" % self.region,
+            "endpoint=%s" % (self.endpoint % self.region),
             "region=%s" % self.region,
             "release=%s" % self.release,
             "root_store=%s" % self.root_store,
             "virt=hvm",
         ]
 
+    @property
+    def regional_filter(self):
+        """Create filter matching the image in any region of the partition.
+
+        The endpoint embeds the region, so it is matched with the region
+        left open rather than dropped, which keeps other partitions sharing
+        the content out of the results.
+        """
+        pattern = "[^.]+".join(re.escape(part) for part in self.endpoint.split("%s"))
+        return [
+            "endpoint~^%s$" % pattern if item.startswith("endpoint=") else item
+            for item in super().regional_filter
+        ]
+
 
 class AWSChina(AWS):
     """AWS China class."""
 
     name = "AWS China"
-
-    @property
-    def filter(self):
-        """Create filter."""
-        return [
-            "arch=%s" % self.arch,
-            "endpoint=https://ec2.%s.amazonaws.com.cn" % self.region,
-            "region=%s" % self.region,
-            "release=%s" % self.release,
-            "root_store=%s" % self.root_store,
-            "virt=hvm",
-        ]
+    content_id = "aws-cn"
+    endpoint = "https://ec2.%s.amazonaws.com.cn"
 
 
 class AWSGovCloud(AWS):
     """AWS GovCloud class."""
 
     name = "AWS GovCloud"
-
-    @property
-    def filter(self):
-        """Create filter."""
-        return [
-            "arch=%s" % self.arch,
-            "endpoint=https://ec2.%s.amazonaws-govcloud.com" % self.region,
-            "region=%s" % self.region,
-            "release=%s" % self.release,
-            "root_store=%s" % self.root_store,
-            "virt=hvm",
-        ]
+    content_id = "aws-govcloud"
+    endpoint = "https://ec2.%s.amazonaws-govcloud.com"
 
 
 class Azure(Image):
     """Azure class."""
 
     name = "Azure"
+    content_id = "azure"
+    arches = ("amd64",)
 
     def __init__(self, release, arch, region, daily=False):
         """Initialize Azure instance.
@@ -209,6 +406,8 @@ class GCE(Image):
     """GCE class."""
 
     name = "GCE"
+    content_id = "gce"
+    arches = ("amd64",)
 
     def __init__(self, release, arch, region, daily=False, minimal=False):
         """Initialize GCE instance.
@@ -250,6 +449,7 @@ class KVM(Image):
     """KVM class."""
 
     name = "KVM"
+    content_id = "download"
 
     @property
     def filter(self):
@@ -265,6 +465,7 @@ class LXC(Image):
     """LXC class."""
 
     name = "LXC"
+    content_id = "download"
 
     @property
     def filter(self):
@@ -280,6 +481,7 @@ class MAASv2(Image):
     """MAAS v2 class."""
 
     name = "MAAS (v2)"
+    content_id = "download"
 
     def __init__(self, release, arch, kernel="generic", daily=False):
         """Initialize MAAS v2 instance.
@@ -316,6 +518,7 @@ class MAASv3(Image):
     """MAAS v3 class."""
 
     name = "MAAS"
+    content_id = "download"
 
     def __init__(self, release, arch, kernel="generic"):
         """Initialize MAAS v3 instance.
@@ -341,3 +544,120 @@ class MAASv3(Image):
             "kflavor=%s" % self.kernel,
             "release=%s" % self.release,
         ]
+
+
+CLOUDS = {
+    "azure": Azure,
+    "aws": AWS,
+    "aws-cn": AWSChina,
+    "aws-govcloud": AWSGovCloud,
+    "gce": GCE,
+    "kvm": KVM,
+    "lxc": LXC,
+    "maasv2": MAASv2,
+    "maas": MAASv3,
+}
+
+# Region looked up on the clouds that require one when none is given.
+DEFAULT_REGIONS = {
+    "aws": "us-east-1",
+    "aws-cn": "cn-north-1",
+    "aws-govcloud": "us-gov-west-1",
+    "azure": "West US",
+    "gce": "us-central1",
+}
+
+
+def default_images(release, arch=None, regions=None):
+    """Create the Image of every cloud with default arguments.
+
+    Clouds without images of the requested architecture (e.g. arm64 on
+    Azure) get an image of their default architecture instead.
+
+    Args:
+        release: Ubuntu release codename
+        arch: architecture of the images (default: each cloud's default)
+        regions: dictionary of cloud name to region overriding
+            DEFAULT_REGIONS
+
+    Returns:
+        dictionary of cloud name to Image instance
+
+    """
+    regions = dict(DEFAULT_REGIONS, **(regions or {}))
+
+    images = {}
+    for name, cloud in CLOUDS.items():
+        cloud_arch = arch if arch in cloud.arches else cloud.arches[0]
+        if name in regions:
+            images[name] = cloud(release, cloud_arch, regions[name])
+        else:
+            images[name] = cloud(release, cloud_arch)
+
+    return images
+
+
+def search_all(release, arch=None, regions=None, **kwargs):
+    """Find the latest image of a release on every cloud.
+
+    Clouds sharing a mirror are looked up with a single sync of it, and
+    the different mirrors are synced concurrently.
+
+    Args:
+        release: Ubuntu release codename
+        arch: architecture of the images (default: each cloud's default)
+        regions: dictionary of cloud name to region overriding
+            DEFAULT_REGIONS
+        kwargs: additional arguments passed to Streams (e.g. cache)
+
+    Returns:
+        dictionary of cloud name to discovered image or empty
+
+    """
+    images = default_images(release, arch, regions)
+
+    return dict(zip(images, search_many(list(images.values()), **kwargs)))
+
+
+def image_from_query(name, query):
+    """Create the Image of a cloud from the arguments of a query.
+
+    Used for the queries of the daemon and of batch files: keys may be
+    spelled like the command-line options (e.g. root-store), flags may be
+    booleans or strings such as "1" or "true", and arch defaults to amd64.
+
+    Args:
+        name: cloud name as used by the CLI (e.g. aws)
+        query: dictionary of the cloud arguments
+
+    Returns:
+        Image instance
+
+    Raises:
+        KeyError: when the cloud is unknown
+        TypeError: when the arguments do not match the cloud, naming the
+            unknown or missing ones
+
+    """
+    cloud = CLOUDS[name]
+
+    args = {"arch": "amd64"}
+    for key, value in query.items():
+        key = key.replace("-", "_")
+        if key in FLAGS and not isinstance(value, bool):
+            value = str(value).lower() in ("1", "true", "yes")
+        args[key] = value
+
+    parameters = inspect.signature(cloud).parameters
+    unknown = sorted(set(args) - set(parameters))
+    if unknown:
+        raise TypeError("unknown arguments for %s: %s" % (name, ", ".join(unknown)))
+    missing = [
+        key
+        for key, parameter in parameters.items()
+        if parameter.default is parameter.empty and key not in args
+    ]
+    if missing:
+        raise TypeError("missing arguments for %s: %s" % (name, ", ".join(missing)))
+
+    return cloud(**args)
@@ -0,0 +1,339 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Local SQLite index of streams for fast lookups."""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from .cache import cache_dir
+from .predicate import Predicate
+from .streams import Streams
+
+COLUMNS = (
+    "release",
+    "arch",
+    "region",
+    "root_store",
+    "ftype",
+    "kflavor",
+    "endpoint",
+    "virt",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mirrors (
+    mirror_url TEXT PRIMARY KEY,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    mirror_url TEXT NOT NULL,
+    content_id TEXT NOT NULL,
+    cloud TEXT NOT NULL,
+    %s,
+    version_name TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_lookup ON images (
+    mirror_url, cloud, release, arch, region, root_store, ftype, kflavor, serial
+);
+""" % ",\n    ".join(
+    "%s TEXT" % column for column in COLUMNS
+)
+
+
+def default_index_path():
+    """Path of the index in the cache directory."""
+    return os.path.join(cache_dir(), "index.sqlite")
+
+
+def sortable_serial(version_name):
+    """Convert a version name into a string that sorts like the serial.
+
+    Numeric parts are zero padded so 20210315.10 sorts after 20210315.9.
+
+    Args:
+        version_name: version name (serial) of a product version
+
+    Returns:
+        string sorting in serial order
+
+    """
+    return ".".join(
+        part.zfill(12) if part.isdigit() else part for part in version_name.split(".")
+    )
+
+
+def parse_filter(img_filter):
+    """Split filters into exact matches on indexed columns and the rest.
+
+    Args:
+        img_filter: array of filters as strings format 'key=value'
+
+    Returns:
+        tuple of a dictionary of column values and a list of the
+        remaining filters
+
+    """
+    exact = {}
+    remaining = []
+    for item in img_filter:
+        key, sep, value = item.partition("=")
+        if sep and key in COLUMNS:
+            exact[key] = value
+        else:
+            remaining.append(item)
+
+    return exact, remaining
+
+
+class Index:
+    """SQLite index of every image item of a set of mirrors.
+
+    Each item of a mirror is stored with the fields the Image filters use
+    as columns, so a lookup is a single indexed query instead of a full
+    walk of the product tree.
+    """
+
+    def __init__(self, path=None):
+        """Initialize Index class.
+
+        Args:
+            path: path to the SQLite database (default: in the cache dir)
+        """
+        self._log = logging.getLogger(__name__)
+
+        self.path = path or default_index_path()
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        """Database connection, created with the schema on first use."""
+        if self._connection is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+
+        return self._connection
+
+    def updated(self, mirror_url):
+        """Return the index updated timestamp of an indexed mirror.
+
+        Args:
+            mirror_url: URL of the streams mirror
+
+        Returns:
+            updated timestamp or None if the mirror is not indexed
+
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT updated FROM mirrors WHERE mirror_url = ?", (mirror_url,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def has_mirror(self, mirror_url):
+        """Check if a mirror is in the index.
+
+        Args:
+            mirror_url: URL of the streams mirror
+
+        Returns:
+            True if the mirror was indexed
+
+        """
+        return self.updated(mirror_url) is not None
+
+    def is_current(self, mirror_url, keyring_path, **kwargs):
+        """Check if a mirror was indexed from its current streams index.
+
+        Only the streams index is read, from the cache within its TTL.
+
+        Args:
+            mirror_url: URL of the streams mirror
+            keyring_path: path to keyring used to verify signed content
+            kwargs: additional arguments passed to Streams (e.g. cache)
+
+        Returns:
+            True if the mirror was indexed with the updated timestamp of
+            its current streams index
+
+        """
+        updated = self.updated(mirror_url)
+        if updated is None:
+            return False
+
+        stream = Streams(mirror_url=mirror_url, keyring_path=keyring_path, **kwargs)
+        return stream.index().get("updated") == updated
+
+    def mirrors(self):
+        """Return the URLs of the indexed mirrors."""
+        with self._lock:
+            rows = self.connection.execute("SELECT mirror_url FROM mirrors").fetchall()
+
+        return [row[0] for row in rows]
+
+    def build(self, mirror_url, keyring_path, force=False, **kwargs):
+        """Index every item of a mirror.
+
+        The mirror is only re-indexed when the updated timestamp of its
+        streams index changed since it was last indexed.
+
+        Args:
+            mirror_url: URL of the streams mirror
+            keyring_path: path to keyring used to verify signed content
+            force: rebuild even if the streams index did not change
+            kwargs: additional arguments passed to Streams (e.g. cache)
+
+        Returns:
+            True if the mirror was (re-)indexed
+
+        """
+        stream = Streams(mirror_url=mirror_url, keyring_path=keyring_path, **kwargs)
+
+        updated = stream.index().get("updated")
+        if not force and updated and updated == self.updated(mirror_url):
+            self._log.debug("index of %s is up to date", mirror_url)
+            return False
+
+        rows = [self._row(mirror_url, entry) for entry in stream.query([])]
+        with self._lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM images WHERE mirror_url = ?", (mirror_url,)
+            )
+            self.connection.executemany(
+                "INSERT INTO images VALUES (%s)" % ", ".join("?" * (len(COLUMNS) + 6)),
+                rows,
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO mirrors VALUES (?, ?)", (mirror_url, updated)
+            )
+
+        self._log.debug("indexed %s items of %s", len(rows), mirror_url)
+        return True
+
+    @staticmethod
+    def _row(mirror_url, entry):
+        """Convert a streams entry into an images row."""
+        content_id = entry.get("content_id", "")
+        values = [mirror_url, content_id, content_id.rpartition(":")[2]]
+        values.extend(
+            str(entry[column]) if column in entry else None for column in COLUMNS
+        )
+        values.extend(
+            [
+                entry["version_name"],
+                sortable_serial(entry["version_name"]),
+                json.dumps(entry, sort_keys=True),
+            ]
+        )
+
+        return values
+
+    def query(self, mirror_url, img_filter, cloud=None, limit=None):
+        """Query the index for images matching a filter.
+
+        Args:
+            mirror_url: URL of the streams mirror
+            img_filter: array of filters as strings format 'key=value'
+            cloud: optional content_id suffix (e.g. aws) to limit to
+            limit: maximum number of images to return
+
+        Returns:
+            list of matching images, newest first
+
+        """
+        exact, remaining = parse_filter(img_filter)
+        if cloud:
+            exact["cloud"] = cloud
+
+        where = " AND ".join(["mirror_url = ?"] + ["%s = ?" % key for key in exact])
+        sql = "SELECT data FROM images WHERE %s ORDER BY serial DESC" % where
+        params = [mirror_url] + list(exact.values())
+        if limit and not remaining:
+            sql += " LIMIT %d" % limit
+
+        with self._lock:
+            rows = self.connection.execute(sql, params).fetchall()
+
+        entries = [json.loads(row[0]) for row in rows]
+        if remaining:
+            predicate = Predicate(remaining)
+            entries = [entry for entry in entries if predicate.match(entry)]
+
+        return entries[:limit] if limit else entries
+
+    def search(self, image):
+        """Find the latest image for an Image from the index.
+
+        Args:
+            image: Image instance
+
+        Returns:
+            dictionary of discovered image or empty
+
+        """
+        entries = self.query(
+            image.mirror_url, image.filter, cloud=image.content_id, limit=1
+        )
+
+        return entries[0] if entries else {}
+
+    def history(self, image, last=None, since=None, until=None):
+        """Find the images of the last serials or of a date range of an Image.
+
+        Args:
+            image: Image instance
+            last: number of most recent serials to return
+            since: only return serials dated on or after this date
+                (YYYYMMDD)
+            until: only return serials dated on or before this date
+                (YYYYMMDD)
+
+        Returns:
+            list of discovered images, newest first
+
+        """
+        entries = self.query(image.mirror_url, image.filter, cloud=image.content_id)
+
+        serials = set()
+        result = []
+        for entry in entries:
+            serial = entry["version_name"]
+            if since and serial[:8] < since or until and serial[:8] > until:
+                continue
+            if serial not in serials:
+                if last is not None and len(serials) == last:
+                    break
+                serials.add(serial)
+            result.append(entry)
+
+        return result
+
+    def search_regions(self, image, regions=None):
+        """Find the latest image of every region of an Image.
+
+        Args:
+            image: Image instance
+            regions: list of regions to limit to (default: all regions)
+
+        Returns:
+            dictionary of region to discovered image
+
+        """
+        entries = self.query(
+            image.mirror_url, image.regional_filter, cloud=image.content_id
+        )
+
+        result = {}
+        for entry in entries:
+            region = entry.get("region")
+            if region and region not in result and (not regions or region in regions):
+                result[region] = entry
+
+        return result
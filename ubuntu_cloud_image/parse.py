@@ -0,0 +1,107 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Incremental parsing of streams documents."""
+
+import json
+import re
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+_DECODER = json.JSONDecoder()
+_DISCARD = object()
+
+
+def _skip(content, index, char=None):
+    """Skip whitespace and, if given, an expected character.
+
+    Returns:
+        index of the next token
+
+    Raises:
+        json.JSONDecodeError: when the expected character is missing
+
+    """
+    index = WHITESPACE.match(content, index).end()
+    if char is None:
+        return index
+
+    if not content.startswith(char, index):
+        raise json.JSONDecodeError("Expecting '%s'" % char, content, index)
+
+    return WHITESPACE.match(content, index + 1).end()
+
+
+def _object(content, index, decode_value, obj):
+    """Parse a JSON object one member at a time.
+
+    Args:
+        content: JSON document
+        index: position of the opening brace
+        decode_value: function of the member name and the position of
+            its value, returning the value, or _DISCARD to leave the
+            member out, and the position after it
+        obj: dictionary the members are added to
+
+    Returns:
+        tuple of the dictionary and the position after the object
+
+    """
+    index = _skip(content, index, "{")
+    if content.startswith("}", index):
+        return obj, index + 1
+
+    while True:
+        if not content.startswith('"', index):
+            raise json.JSONDecodeError("Expecting property name", content, index)
+        (key, index) = _DECODER.raw_decode(content, index)
+        index = _skip(content, index, ":")
+
+        (value, index) = decode_value(key, index)
+        if value is not _DISCARD:
+            obj[key] = value
+
+        index = _skip(content, index)
+        if content.startswith("}", index):
+            return obj, index + 1
+        index = _skip(content, index, ",")
+
+
+def load_products(content, keep_product):
+    """Parse a products document, keeping only the wanted products.
+
+    Products are decoded one at a time and dropped right away when
+    keep_product rejects them, so memory use follows the products kept
+    rather than the size of the document.
+
+    Args:
+        content: JSON document
+        keep_product: function of the product name, the product and the
+            top level members parsed so far, returning True to keep it
+
+    Returns:
+        dictionary of the document
+
+    Raises:
+        json.JSONDecodeError: when the content is not a JSON object
+
+    """
+    data = {}
+
+    def decode_product(name, index):
+        (product, index) = _DECODER.raw_decode(content, index)
+        if not keep_product(name, product, data):
+            return _DISCARD, index
+
+        return product, index
+
+    def decode_member(key, index):
+        if key == "products" and content.startswith("{", index):
+            return _object(content, index, decode_product, {})
+
+        return _DECODER.raw_decode(content, index)
+
+    (data, index) = _object(content, _skip(content, 0), decode_member, data)
+    index = _skip(content, index)
+    if index != len(content):
+        raise json.JSONDecodeError("Extra data", content, index)
+
+    return data
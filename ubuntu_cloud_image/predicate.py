@@ -0,0 +1,153 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Compiled filters for matching streams items."""
+
+import re
+
+# Same syntax as simplestreams filters: key=value, key!=value, key~regex
+# and key!~regex.
+FILTER_FORMAT = re.compile(r"([\w|\-]+)[ ]*([!]{0,1}[=~])[ ]*(.*)[ ]*$")
+
+# Field names simplestreams inserts for each level of the product tree.
+FIELDNAMES = {"product_name": 0, "version_name": 1, "item_name": 2}
+
+
+def compile_filter(item):
+    """Compile a single filter string into a key and test function.
+
+    Args:
+        item: filter as a string in format 'key=value'
+
+    Returns:
+        tuple of the key and a function testing a string value
+
+    Raises:
+        ValueError: when the filter cannot be parsed
+
+    """
+    parsed = FILTER_FORMAT.match(item)
+    if not parsed:
+        raise ValueError("Unable to parse filter %s" % item)
+
+    (key, operator, value) = parsed.groups()
+    if operator == "=":
+        return key, value.__eq__
+    if operator == "!=":
+        return key, value.__ne__
+
+    search = re.compile(value).search
+    if operator == "~":
+        return key, lambda actual: search(actual) is not None
+
+    return key, lambda actual: search(actual) is None
+
+
+def lookup(key, levels, pedigree=()):
+    """Return the value a key has once a product tree is flattened.
+
+    Equivalent to looking the key up in the output of
+    simplestreams.util.products_exdata without building the merged
+    dictionary.
+
+    Args:
+        key: name of the field
+        levels: dictionaries from the most specific (item) to the least
+            specific (top level)
+        pedigree: tuple of product, version and item names
+
+    Returns:
+        value as a string, empty if the key is not set
+
+    """
+    position = FIELDNAMES.get(key)
+    if position is not None and position < len(pedigree):
+        return pedigree[position]
+
+    for level in levels:
+        value = level.get(key)
+        if value is not None and not isinstance(value, (dict, list)):
+            return str(value)
+
+    return ""
+
+
+class Predicate:
+    """Filters compiled once and evaluated with plain dictionary lookups.
+
+    Exact matches compare strings and regular expressions are only used
+    for ~ and !~ filters. Filters on keys set by a product are evaluated
+    once per product with for_product(), leaving only the item level
+    filters to run for each item.
+    """
+
+    def __init__(self, img_filter=None, tests=None):
+        """Initialize Predicate class.
+
+        Args:
+            img_filter: array of filters as strings format 'key=value'
+            tests: already compiled list of key and test function tuples
+        """
+        if tests is None:
+            tests = [compile_filter(item) for item in img_filter or []]
+
+        self.tests = tests
+
+    def __bool__(self):
+        """Return True if there is anything to test."""
+        return bool(self.tests)
+
+    def match(self, data):
+        """Check a flat dictionary, e.g. an index entry.
+
+        Args:
+            data: dictionary to test
+
+        Returns:
+            True if every filter matches
+
+        """
+        return all(test(lookup(key, (data,))) for key, test in self.tests)
+
+    def match_item(self, levels, pedigree):
+        """Check an item without flattening the product tree.
+
+        Args:
+            levels: item, version, product and top level dictionaries
+            pedigree: tuple of product, version and item names
+
+        Returns:
+            True if every filter matches
+
+        """
+        return all(test(lookup(key, levels, pedigree)) for key, test in self.tests)
+
+    def for_product(self, product, src, prodname):
+        """Evaluate the filters decided by a product.
+
+        Filters on keys set on the product, the top level or on the
+        product name are evaluated once. Like simplestreams products,
+        versions and items are expected not to redefine those keys.
+
+        Args:
+            product: product dictionary
+            src: top level products dictionary
+            prodname: name of the product
+
+        Returns:
+            Predicate of the remaining item level filters, or None when
+            the product cannot match
+
+        """
+        remaining = []
+        for key, test in self.tests:
+            if key == "product_name":
+                value = prodname
+            elif key in product or key in src:
+                value = lookup(key, (product, src))
+            else:
+                remaining.append((key, test))
+                continue
+
+            if not test(value):
+                return None
+
+        return Predicate(tests=remaining)
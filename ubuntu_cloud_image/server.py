@@ -0,0 +1,290 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Query daemon keeping a warm in-memory catalogue of the streams."""
+
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import urllib.parse
+
+from .client import DEFAULT_HOST, DEFAULT_PORT, DEFAULT_REFRESH, HISTORY
+from .image import (
+    CLOUDS,
+    DEFAULT_REGIONS,
+    default_images,
+    default_keyring_path,
+    image_from_query,
+)
+from .index import Index
+from .streams import history_date
+
+
+class Catalogue:
+    """In-memory index of the mirrors queried so far.
+
+    A mirror is indexed the first time it is queried and then refreshed
+    in the background, so lookups never wait on the network once warm.
+    """
+
+    def __init__(self, refresh=DEFAULT_REFRESH, **kwargs):
+        """Initialize Catalogue class.
+
+        Args:
+            refresh: seconds between background refreshes of the mirrors
+            kwargs: additional arguments passed to Streams (e.g. cache)
+        """
+        self._log = logging.getLogger(__name__)
+
+        self.refresh = refresh
+        self.streams_args = kwargs
+        self.index = Index(":memory:")
+
+        self._build_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _build(self, mirror_url):
+        """Index a mirror, unless its streams did not change."""
+        with self._build_lock:
+            return self.index.build(
+                mirror_url, default_keyring_path(), **self.streams_args
+            )
+
+    def _indexed(self, image):
+        """Index the mirror of an image on first use."""
+        if not self.index.has_mirror(image.mirror_url):
+            self._build(image.mirror_url)
+
+    def search(self, image):
+        """Find the latest image, indexing its mirror on first use.
+
+        Args:
+            image: Image instance
+
+        Returns:
+            dictionary of discovered image or empty
+
+        """
+        self._indexed(image)
+
+        return self.index.search(image)
+
+    def history(self, image, last=None, since=None, until=None):
+        """Find the images of the last serials or of a date range.
+
+        Args:
+            image: Image instance
+            last: number of most recent serials to return
+            since: only return serials dated on or after this date (YYYYMMDD)
+            until: only return serials dated on or before this date (YYYYMMDD)
+
+        Returns:
+            list of discovered images, newest first
+
+        """
+        self._indexed(image)
+
+        return self.index.history(image, last, since, until)
+
+    def search_regions(self, image, regions=None):
+        """Find the latest image of every region.
+
+        Args:
+            image: Image instance
+            regions: list of regions to limit to (default: all regions)
+
+        Returns:
+            dictionary of region to discovered image
+
+        """
+        self._indexed(image)
+
+        return self.index.search_regions(image, regions)
+
+    def search_all(self, images):
+        """Find the latest image of many clouds.
+
+        A mirror failing to be indexed only fails the clouds it serves.
+
+        Args:
+            images: dictionary of cloud name to Image instance
+
+        Returns:
+            dictionary of cloud name to discovered image, empty or with
+            the error of its mirror
+
+        """
+        result = {}
+        for name, image in images.items():
+            try:
+                result[name] = self.search(image)
+            except Exception as error:  # pylint: disable=broad-except
+                self._log.warning("sync of %s failed: %s", image.mirror_url, error)
+                result[name] = {"error": "%s: %s" % (image.mirror_url, error)}
+
+        return result
+
+    def _refresh_loop(self):
+        """Refresh the indexed mirrors until stopped."""
+        while not self._stopped.wait(self.refresh):
+            for mirror_url in self.index.mirrors():
+                try:
+                    if self._build(mirror_url):
+                        self._log.info("refreshed %s", mirror_url)
+                except Exception as error:  # pylint: disable=broad-except
+                    self._log.warning("refresh of %s failed: %s", mirror_url, error)
+
+    def start(self):
+        """Start refreshing the catalogue in the background."""
+        thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        thread.start()
+
+    def stop(self):
+        """Stop the background refresh."""
+        self._stopped.set()
+
+
+def lookup(catalogue, name, query, regions):
+    """Check a query of the daemon and return the function answering it.
+
+    The queries match the CLI subcommands: several region parameters or
+    all-regions look up the latest image of each region, last, since and
+    until the images of those serials, and the all cloud the latest image
+    of every cloud, its region parameters being CLOUD=REGION overrides.
+
+    Args:
+        catalogue: Catalogue answering the query
+        name: cloud name as used by the CLI (e.g. aws) or all
+        query: dictionary of the other arguments
+        regions: list of the region parameters
+
+    Returns:
+        function without arguments returning the result
+
+    Raises:
+        KeyError: when the cloud is unknown
+        TypeError: when the arguments do not match the cloud
+        ValueError: when an argument is invalid
+
+    """
+    if name == "all":
+        overrides = {}
+        for region in regions:
+            (cloud, sep, value) = region.partition("=")
+            if not sep or cloud not in DEFAULT_REGIONS:
+                raise ValueError(
+                    "region must be CLOUD=REGION with CLOUD one of %s"
+                    % ", ".join(DEFAULT_REGIONS)
+                )
+            overrides[cloud] = value
+        unknown = sorted(set(query) - {"release", "arch"})
+        if unknown:
+            raise TypeError("unknown arguments for all: %s" % ", ".join(unknown))
+        if "release" not in query:
+            raise TypeError("missing arguments for all: release")
+        images = default_images(query["release"], query.get("arch"), overrides)
+        return lambda: catalogue.search_all(images)
+
+    if name not in CLOUDS:
+        raise KeyError(name)
+
+    (last, since, until) = (query.pop(key, None) for key in HISTORY)
+    if last is not None:
+        if not last.isdigit() or int(last) < 1:
+            raise ValueError("last must be a number of at least 1")
+        last = int(last)
+    since = history_date(since) if since else None
+    until = history_date(until) if until else None
+
+    all_regions = str(query.pop("all_regions", "")).lower() in ("1", "true", "yes")
+    if all_regions or len(regions) > 1:
+        if last is not None or since or until:
+            raise ValueError("last, since and until take a single region")
+        image = image_from_query(name, dict(query, region=None))
+        return lambda: catalogue.search_regions(image, None if all_regions else regions)
+    if regions:
+        query["region"] = regions[0]
+
+    image = image_from_query(name, query)
+    if last is not None or since or until:
+        return lambda: catalogue.history(image, last, since, until)
+
+    return lambda: catalogue.search(image)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answer GET /<cloud>?release=... with the same lookups as the CLI.
+
+    See lookup for the supported queries.
+    """
+
+    catalogue = None
+
+    def _send(self, code, body):
+        """Send a JSON response."""
+        content = json.dumps(body, sort_keys=True).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Look up the image of the requested cloud."""
+        url = urllib.parse.urlsplit(self.path)
+        query = {}
+        regions = []
+        for key, value in urllib.parse.parse_qsl(url.query):
+            key = key.replace("-", "_")
+            if key == "region":
+                regions.append(value)
+            else:
+                query[key] = value
+
+        try:
+            answer = lookup(self.catalogue, url.path.strip("/"), query, regions)
+        except KeyError:
+            self._send(404, {"error": "unknown cloud"})
+            return
+        except (TypeError, ValueError) as error:
+            self._send(400, {"error": str(error)})
+            return
+
+        try:
+            self._send(200, answer())
+        except Exception as error:  # pylint: disable=broad-except
+            self._send(502, {"error": str(error)})
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Log requests at debug level."""
+        logging.getLogger(__name__).debug(*args)
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded HTTP server."""
+
+    daemon_threads = True
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, refresh=DEFAULT_REFRESH, **kwargs):
+    """Run the query daemon until interrupted.
+
+    Args:
+        host: address to listen on
+        port: port to listen on
+        refresh: seconds between background refreshes of the mirrors
+        kwargs: additional arguments passed to Streams (e.g. cache)
+    """
+    catalogue = Catalogue(refresh, **kwargs)
+    catalogue.start()
+
+    handler = type("Handler", (RequestHandler,), {"catalogue": catalogue})
+    server = Server((host, port), handler)
+    logging.getLogger(__name__).info("listening on http://%s:%s/", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        catalogue.stop()
+        server.server_close()
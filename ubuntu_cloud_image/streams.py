@@ -1,119 +1,499 @@
 # This file is part of pycloudlib. See LICENSE file for license information.
-"""Wrapper class around Simplestreams."""
+"""Wrapper class around Simplestreams.
 
-import importlib
+Simplestreams itself is only imported, through the sync module, once a
+mirror really has to be synced, so that commands answered from the cache
+or an index start fast.
+"""
+
+import concurrent.futures
+import datetime
+import functools
+import json
 import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+from .cache import keyring_identity, write_file
+from .hooks import Hooks
+from .predicate import Predicate
 
-from simplestreams import filters, mirrors
-from simplestreams import util as s_util
+DEFAULT_WORKERS = 4
+ASYNC_WORKERS = 32
 
-# Simplestreams import's above grab the root logger and set the
-# log level up how it thinks they should be. This is bad and breaks
-# end-user logging. This reloads the logging module to ignore the
-# settings set by simplestreams.
-logging.shutdown()
-importlib.reload(logging)
+HISTORY_DATE = re.compile(r"\d{4}-\d{2}-\d{2}|\d{8}")
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
 
 
 class Streams:
     """Streams Class."""
 
-    def __init__(self, mirror_url, keyring_path):
-        """Initialize Steams Class."""
+    def __init__(
+        self,
+        mirror_url,
+        keyring_path,
+        cache=None,
+        workers=DEFAULT_WORKERS,
+        incremental=True,
+        verify=True,
+        hooks=None,
+        streaming=False,
+        mirror_dir=None,
+    ):
+        """Initialize Steams Class.
+
+        Args:
+            mirror_url: URL of the streams mirror
+            keyring_path: path to keyring used to verify signed content
+            cache: optional Cache to read streams metadata through
+            workers: number of product files downloaded concurrently
+            incremental: with a cache, reuse the parsed product files
+                whose index entry did not change since the last sync
+            verify: check signatures, only disable for trusted local
+                copies of the streams (e.g. benchmarks)
+            hooks: optional Hooks notified of the time spent in each
+                phase of a query
+            streaming: parse product files incrementally, keeping only
+                the products that can match, instead of reusing parsed
+                product files
+            mirror_dir: directory of local copies of the mirrors, made by
+                snapshot(), to read instead of mirror_url. Item URLs still
+                point at mirror_url, as only the metadata is copied.
+        """
         self._log = logging.getLogger(__name__)
 
         self.mirror_url = mirror_url
+        self.mirror_dir = mirror_dir
         self.keyring_path = keyring_path
-
-    def query(self, img_filter):
+        self.cache = cache
+        self.workers = workers
+        self.incremental = incremental
+        self.verify = verify
+        self.hooks = hooks or Hooks()
+        self._observed = hooks is not None
+        self.streaming = streaming
+
+    def query(
+        self,
+        img_filter,
+        index_filter=None,
+        latest_only=False,
+        group_by=None,
+        last=None,
+        since=None,
+        until=None,
+    ):
         """Query streams for latest image given a specific filter.
 
         Args:
             img_filter: array of filters as strings format 'key=value'
+            index_filter: array of filters applied to the index entries,
+                non-matching product files are never downloaded
+            latest_only: only return the newest version of each product
+            group_by: item field (e.g. region) to return the newest
+                version of each value of, implies latest_only
+            last: only return the images of the last serials, at most
+                this many, instead of the newest version of each product
+            since: only return images of serials dated on or after this
+                date (YYYYMMDD or YYYY-MM-DD)
+            until: only return images of serials dated on or before this
+                date (YYYYMMDD or YYYY-MM-DD)
 
         Returns:
-            dictionary with latest image information or empty
+            list of matching images, newest first when latest_only or a
+            history option (last, since, until) is set, or dictionary of
+            group_by value to matching images
 
         """
+        return self.query_many(
+            [img_filter],
+            [index_filter],
+            latest_only,
+            group_by=group_by,
+            last=last,
+            since=since,
+            until=until,
+        )[0]
+
+    async def aquery(
+        self,
+        img_filter,
+        index_filter=None,
+        latest_only=False,
+        group_by=None,
+        last=None,
+        since=None,
+        until=None,
+    ):
+        """Query streams without blocking the event loop.
+
+        The sync runs in the thread pool shared by Streams, so many
+        lookups can be in flight on a single event loop, downloading over
+        the kept-alive connections of the cache module.
 
-        def policy(content, path):  # pylint: disable=W0613
-            """Read signed content with the defined keyring."""
-            return s_util.read_signed(content, keyring=self.keyring_path)
+        Args:
+            img_filter: array of filters as strings format 'key=value'
+            index_filter: array of filters applied to the index entries
+            latest_only: only return the newest version of each product
+            group_by: item field (e.g. region) to return the newest
+                version of each value of, implies latest_only
+            last: only return the images of the last serials
+            since: only return images of serials dated on or after this
+                date (YYYYMMDD or YYYY-MM-DD)
+            until: only return images of serials dated on or before this
+                date (YYYYMMDD or YYYY-MM-DD)
 
-        (url, path) = s_util.path_from_mirror_url(self.mirror_url, None)
-        s_mirror = mirrors.UrlMirrorReader(url, policy=policy)
+        Returns:
+            same result as query
+
+        """
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            executor(),
+            functools.partial(
+                self.query,
+                img_filter,
+                index_filter,
+                latest_only,
+                group_by=group_by,
+                last=last,
+                since=since,
+                until=until,
+            ),
+        )
+
+    def query_many(
+        self,
+        img_filters,
+        index_filters=None,
+        latest_only=False,
+        group_by=None,
+        last=None,
+        since=None,
+        until=None,
+    ):
+        """Query streams for many filters with a single mirror sync.
+
+        Args:
+            img_filters: list of filters, each an array of strings in
+                format 'key=value'
+            index_filters: list of index filters, one per filter
+            latest_only: only return the newest version of each product
+            group_by: item field (e.g. region) to return the newest
+                version of each value of, implies latest_only
+            last: only return the images of the last serials of each
+                filter, at most this many
+            since: only return images of serials dated on or after this
+                date (YYYYMMDD or YYYY-MM-DD)
+            until: only return images of serials dated on or before this
+                date (YYYYMMDD or YYYY-MM-DD)
+
+        Returns:
+            list with the matching images of each filter, or with
+            dictionaries of group_by value to matching images
 
-        config = {"filters": filters.get_filters(img_filter)}
+        Raises:
+            ValueError: when since or until is not a valid date
 
-        t_mirror = FilterMirror(config)
+        """
+        if index_filters is None:
+            index_filters = [None] * len(img_filters)
+
+        history = {
+            "last": last,
+            "since": history_date(since) if since else None,
+            "until": history_date(until) if until else None,
+        }
+
+        # Lookups of the newest or last images are kept by the cache for its
+        # TTL, during which a sync would read the same cached streams anyway.
+        # Hooks observing the sync (e.g. a profile) always get a real one.
+        key = None
+        if (
+            self.cache
+            and not self._observed
+            and (latest_only or group_by or last is not None)
+        ):
+            key = json.dumps(
+                [
+                    self.mirror_url,
+                    self.mirror_dir,
+                    self.keyring_path,
+                    self.verify,
+                    img_filters,
+                    index_filters,
+                    latest_only,
+                    group_by,
+                    history,
+                ]
+            )
+            results = self.cache.load_result(key)
+            if results is not None:
+                return results
+
+        results = self._sync(img_filters, index_filters, latest_only, group_by, history)
+        if key:
+            self.cache.store_result(key, results)
+
+        return results
+
+    def _sync(self, img_filters, index_filters, latest_only, group_by, history):
+        """Sync the mirror, filtering it for each filter set."""
+        from . import sync  # pylint: disable=import-outside-toplevel
+
+        (url, path) = sync.s_util.path_from_mirror_url(self.mirror_url, None)
+        s_mirror = self._reader(url)
+
+        config = {
+            "filter_sets": [Predicate(img_filter) for img_filter in img_filters],
+            "index_filter_sets": [
+                Predicate(index_filter) for index_filter in index_filters
+            ],
+            "latest_only": latest_only,
+            "group_by": group_by,
+            "hooks": self.hooks,
+        }
+        config.update(history)
+
+        t_mirror = sync.FilterMirror(config)
+        self._prefetch(s_mirror, t_mirror, path)
         t_mirror.sync(s_mirror, path)
 
-        return t_mirror.json_entries
+        start = time.perf_counter()
+        results = t_mirror.groups if group_by else t_mirror.results
+        elapsed = time.perf_counter() - start
+        self.hooks.phase("expand", s_mirror.base_url + path, elapsed)
 
+        return results
 
-class FilterMirror(mirrors.BasicMirrorWriter):
-    """Taken from sstream-query to return query result as json array."""
+    def index(self):
+        """Read the streams index of the mirror.
 
-    def __init__(self, config=None):
-        """Initialize custom Filter Mirror class.
+        Returns:
+            dictionary of the verified index
 
-        Args:
-            config: custom config to use
         """
-        super(FilterMirror, self).__init__(config=config)
+        from . import sync  # pylint: disable=import-outside-toplevel
 
-        if config is None:
-            config = {}
+        (url, path) = sync.s_util.path_from_mirror_url(self.mirror_url, None)
 
-        self.config = config
-        self.filters = config.get("filters", [])
-        self.json_entries = []
+        return self._reader(url).load_document(path)
 
-    def load_products(self, path=None, content_id=None):
-        """Load each product.
+    def snapshot(self, directory):
+        """Copy the signed index and product files into a directory.
+
+        Every file is verified as it is copied. Product files whose index
+        entry did not change since the previous snapshot are kept, and the
+        index is written last so readers never see it ahead of its files.
 
         Args:
-            path: path the product
-            content_id: ID of product
+            directory: directory of the local copies of the mirrors
 
         Returns:
-            dictionary of products
+            number of product files copied
+
+        """
+        from .sync import load_mapped, s_util  # pylint: disable=import-outside-toplevel
 
+        (url, path) = s_util.path_from_mirror_url(self.mirror_url, None)
+        reader = self._reader(url, local=False)
+        target = urllib.parse.unquote(
+            urllib.parse.urlsplit(local_mirror_url(directory, url)).path
+        )
+
+        try:
+            content = load_mapped(os.path.join(target, path))
+            previous = s_util.load_content(s_util.read_signed(content, checked=False))
+        except (OSError, ValueError):
+            previous = {}
+
+        (raw, payload) = reader.read_json(path)
+        index = s_util.load_content(payload)
+
+        copied = 0
+        for content_id, entry in index.get("index", {}).items():
+            entry_path = entry.get("path")
+            if not entry_path:
+                continue
+
+            old_entry = previous.get("index", {}).get(content_id, {})
+            if (
+                entry.get("updated")
+                and old_entry.get("updated") == entry["updated"]
+                and old_entry.get("path") == entry_path
+                and os.path.exists(os.path.join(target, entry_path))
+            ):
+                continue
+
+            (entry_raw, _) = reader.read_json(entry_path)
+            write_file(os.path.join(target, entry_path), entry_raw.encode("utf-8"))
+            copied += 1
+
+        write_file(os.path.join(target, path), raw.encode("utf-8"))
+        self._log.debug("copied %s product files of %s", copied, url)
+
+        return copied
+
+    def _reader(self, url, local=True):
+        """Create a mirror reader verifying content with the keyring.
+
+        With a mirror_dir, and unless local is False, the metadata is read
+        from the local copy of the mirror while item URLs keep pointing
+        at the mirror.
         """
-        return {"content_id": content_id, "products": {}}
+        from . import sync  # pylint: disable=import-outside-toplevel
 
-    def filter_item(self, data, src, target, pedigree):
-        """Filter items based on filter.
+        def policy(content, path):  # pylint: disable=W0613
+            """Read signed content with the defined keyring."""
+            return self._read_signed(content)
+
+        read_url = url
+        if self.mirror_dir and local:
+            read_url = local_mirror_url(self.mirror_dir, url)
+
+        return sync.StreamsMirrorReader(
+            read_url,
+            policy=policy,
+            cache=self.cache,
+            hooks=self.hooks,
+            content_url=url,
+        )
+
+    def _prefetch(self, s_mirror, t_mirror, path):
+        """Prepare the product files a sync is going to need.
+
+        In streaming mode products are filtered while product files are
+        parsed. Otherwise, in incremental mode, each product file is tagged
+        with the updated timestamp of its index entry and the identity of
+        the keyring, so an unchanged file verified with the same keyring is
+        loaded from its parsed copy in the cache. Product files are then
+        downloaded concurrently.
 
         Args:
-            data: Streams data
-            src: Top level products
-            target: Top level products
-            pedigree: No freaking clue
+            s_mirror: StreamsMirrorReader used for the sync
+            t_mirror: FilterMirror used to filter the index entries
+            path: path of the index relative to the mirror
+        """
+        index = s_mirror.load_document(path)
+        if index.get("format") != "index:1.0":
+            return
+
+        entries = [
+            entry
+            for content_id, entry in index.get("index", {}).items()
+            if entry.get("path")
+            and t_mirror.filter_index_entry(entry, index, (content_id,))
+        ]
+
+        if self.streaming:
+            s_mirror.keep_product = t_mirror.keep_product
+        elif self.cache and self.incremental and self.verify and self.keyring_path:
+            try:
+                keyring = keyring_identity(self.keyring_path)
+            except OSError:
+                keyring = None
+            for entry in entries:
+                if keyring and entry.get("updated"):
+                    s_mirror.tags[entry["path"]] = "%s\0%s" % (
+                        entry["updated"],
+                        keyring,
+                    )
+
+        if self.workers > 1 and len(entries) > 1:
+            s_mirror.prefetch([entry["path"] for entry in entries], self.workers)
+
+    def _read_signed(self, content):
+        """Verify and read signed content.
+
+        With a cache, content already verified against the same keyring
+        is trusted without running gpg again.
+
+        Args:
+            content: signed content
 
         Returns:
-            Filtered items
+            content with the signature stripped
 
         """
-        return filters.filter_item(self.filters, data, src, pedigree)
+        from .sync import s_util  # pylint: disable=import-outside-toplevel
 
-    def insert_item(self, data, src, target, pedigree, contentsource):
-        """Insert item received.
+        if not self.verify:
+            return s_util.read_signed(content, checked=False)
 
-        src and target are top level products:1.0
-        data is src['products'][ped[0]]['versions'][ped[1]]['items'][ped[2]]
-        contentsource is a ContentSource if 'path' exists in data or None
+        if (
+            not self.cache
+            or not self.keyring_path
+            or not content.startswith(s_util.PGP_SIGNED_MESSAGE_MARKER)
+        ):
+            return s_util.read_signed(content, keyring=self.keyring_path)
 
-        Args:
-            data: Data from simplestreams
-            src: Top level products
-            target: Top level products
-            pedigree: Still no freaking clue
-            contentsource: If source exists or None
-        """
-        data = s_util.products_exdata(src, pedigree)
+        if self.cache.is_verified(content, self.keyring_path):
+            return s_util.read_signed(content, checked=False)
+
+        payload = s_util.read_signed(content, keyring=self.keyring_path)
+        self.cache.set_verified(content, self.keyring_path)
+
+        return payload
+
+
+def history_date(value):
+    """Normalize a date of the history options to YYYYMMDD.
+
+    Args:
+        value: date as YYYY-MM-DD or YYYYMMDD
+
+    Returns:
+        date as YYYYMMDD, the format of the start of serials
+
+    Raises:
+        ValueError: when the value is not a valid date in either format
+
+    """
+    date = value.replace("-", "")
+    try:
+        if HISTORY_DATE.fullmatch(value):
+            datetime.datetime.strptime(date, "%Y%m%d")
+            return date
+    except ValueError:
+        pass
+
+    raise ValueError("invalid date %r, expected YYYY-MM-DD or YYYYMMDD" % value)
+
+
+def local_mirror_url(mirror_dir, mirror_url):
+    """Return the URL of the local copy of a mirror.
+
+    Args:
+        mirror_dir: directory of the local copies of the mirrors
+        mirror_url: URL of the streams mirror
+
+    Returns:
+        file:// URL of the mirror under mirror_dir
+
+    """
+    url = urllib.parse.urlsplit(mirror_url)
+    path = os.path.join(os.path.abspath(mirror_dir), url.netloc, url.path.lstrip("/"))
+
+    return "file://%s/" % urllib.parse.quote(path.rstrip("/"))
+
+
+def executor():
+    """Return the thread pool used to run async queries.
 
-        if "path" in data:
-            data.update({"item_url": contentsource.url})
+    The pool is created on first use and shared by every Streams.
+    """
+    global _EXECUTOR  # pylint: disable=global-statement
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=ASYNC_WORKERS, thread_name_prefix="streams"
+            )
 
-        self.json_entries.append(data)
+    return _EXECUTOR
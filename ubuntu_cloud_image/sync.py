@@ -0,0 +1,665 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Simplestreams mirror reader and writer used by Streams."""
+
+import concurrent.futures
+import heapq
+import logging
+import mmap
+import os
+import threading
+import time
+import urllib.parse
+
+from .cache import download
+from .hooks import Hooks
+from .parse import load_products
+from .predicate import Predicate, lookup
+
+# Importing simplestreams adds a handler to the root logger when it has
+# none, which turns logging.basicConfig() into a no-op and breaks end-user
+# logging. Put the root logger back the way it was once imported.
+_ROOT_LOGGER = logging.getLogger()
+_ROOT_HANDLERS = list(_ROOT_LOGGER.handlers)
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from simplestreams import mirrors  # noqa: E402
+from simplestreams import util as s_util  # noqa: E402
+
+_ROOT_LOGGER.handlers[:] = _ROOT_HANDLERS
+
+
+def load_mapped(path):
+    """Read a local text file through a memory map.
+
+    The text is decoded straight from the mapped pages, without reading
+    the file into an intermediate bytes copy.
+
+    Args:
+        path: path of the file
+
+    Returns:
+        content of the file as a string
+
+    """
+    with open(path, "rb") as mapped_file:
+        if not os.fstat(mapped_file.fileno()).st_size:
+            return ""
+        with mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return str(mapped, "utf-8")
+
+
+class StreamsMirrorReader(mirrors.UrlMirrorReader):
+    """URL mirror reader that can read through a Cache and prefetch files.
+
+    Documents read or prefetched are kept for the lifetime of the reader,
+    so a sync consumes already downloaded and verified files. Documents
+    with a tag are also stored parsed in the cache and loaded from there
+    as long as their tag does not change. Once parsed, the raw content of
+    a document is dropped.
+    """
+
+    def __init__(self, prefix, policy, cache=None, hooks=None, content_url=None):
+        """Initialize streams mirror reader.
+
+        Args:
+            prefix: base URL the metadata is read from
+            policy: function to read and verify signed content
+            cache: optional Cache to read metadata through
+            hooks: optional Hooks notified of downloads, verification
+                and parsing
+            content_url: base URL of the items, e.g. the mirror a local
+                copy of the metadata was made from (default: prefix)
+        """
+        super(StreamsMirrorReader, self).__init__(content_url or prefix, policy=policy)
+
+        self.base_url = prefix if prefix.endswith("/") else "%s/" % prefix
+        self.cache = cache
+        self.hooks = hooks or Hooks()
+
+        self.tags = {}
+        self.keep_product = None
+
+        self._documents = {}
+        self._parsed = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, path):
+        """Download a file, through the cache if there is one."""
+        url = self.base_url + path
+        if self.cache:
+            return self.cache.fetch(url, self.hooks)
+
+        return download(url, self.hooks)[1]
+
+    def read_json(self, path):
+        """Read and verify a metadata file.
+
+        Args:
+            path: path of the file relative to the mirror
+
+        Returns:
+            tuple of raw content and content returned by the policy
+
+        """
+        with self._lock:
+            document = self._documents.get(path)
+        if document:
+            return document
+
+        url = self.base_url + path
+        if url.startswith("file://"):
+            start = time.perf_counter()
+            raw = load_mapped(urllib.parse.unquote(urllib.parse.urlsplit(url).path))
+            self.hooks.phase("download", url, time.perf_counter() - start)
+        else:
+            raw = self._fetch(path).decode("utf-8")
+
+        start = time.perf_counter()
+        document = (raw, self.policy(content=raw, path=path))
+        self.hooks.phase("verify", url, time.perf_counter() - start)
+        with self._lock:
+            self._documents[path] = document
+
+        return document
+
+    def load_document(self, path):
+        """Read, verify and parse a metadata file.
+
+        Args:
+            path: path of the file relative to the mirror
+
+        Returns:
+            parsed document
+
+        """
+        with self._lock:
+            data = self._parsed.get(path)
+        if data is not None:
+            return data
+
+        url = self.base_url + path
+        tag = self.tags.get(path)
+        start = time.perf_counter()
+        if tag is not None:
+            data = self.cache.load_document(url, tag)
+
+        if data is None:
+            (_, payload) = self.read_json(path)
+            start = time.perf_counter()
+            if self.keep_product:
+                data = load_products(payload, self.keep_product)
+            else:
+                data = s_util.load_content(payload)
+            if tag is not None:
+                self.cache.store_document(url, tag, data)
+        self.hooks.phase("parse", url, time.perf_counter() - start)
+
+        with self._lock:
+            self._parsed[path] = data
+            self._documents.pop(path, None)
+
+        return data
+
+    def prefetch(self, paths, workers):
+        """Download, verify and parse files concurrently.
+
+        Args:
+            paths: paths of the files relative to the mirror
+            workers: maximum number of concurrent downloads
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(self.load_document, paths))
+
+
+class FilterMirror(mirrors.BasicMirrorWriter):
+    """Taken from sstream-query to return query result as json array."""
+
+    def __init__(self, config=None):
+        """Initialize custom Filter Mirror class.
+
+        Args:
+            config: custom config to use
+        """
+        super(FilterMirror, self).__init__(config=config)
+
+        if config is None:
+            config = {}
+
+        self.config = config
+        self.filter_sets = config.get(
+            "filter_sets", [config.get("filters", Predicate())]
+        )
+        self.index_filter_sets = config.get(
+            "index_filter_sets", [config.get("index_filters", Predicate())]
+        )
+        self.group_by = config.get("group_by")
+        self.last = config.get("last")
+        self.since = (config.get("since") or "").replace("-", "")
+        self.until = (config.get("until") or "").replace("-", "")
+        self.history = self.last is not None or bool(self.since or self.until)
+        self.latest_only = not self.history and (
+            config.get("latest_only", False) or bool(self.group_by)
+        )
+        self.hooks = config.get("hooks") or Hooks()
+
+        self._entries = [[] for _ in self.filter_sets]
+        self._latest = [{} for _ in self.filter_sets]
+        self._newest = [{} for _ in self.filter_sets]
+        self._serials = [{} for _ in self.filter_sets]
+        self._heaps = [[] for _ in self.filter_sets]
+        self._bounds = [[] for _ in self.filter_sets]
+        self._content_sets = {}
+        self._product_sets = {}
+        self._matched_sets = {}
+        self._examined = 0
+        self._matched = 0
+
+    def sync(self, reader, path):
+        """Sync from parsed documents when the reader provides them.
+
+        Args:
+            reader: mirror reader
+            path: path of the index or products file
+        """
+        load_document = getattr(reader, "load_document", None)
+        if load_document is None:
+            return super(FilterMirror, self).sync(reader, path)
+
+        data = load_document(path)
+        fmt = data.get("format", "UNSPECIFIED")
+        if fmt == "products:1.0":
+            (examined, matched) = (self._examined, self._matched)
+            start = time.perf_counter()
+            self.sync_products(reader, path, data, "")
+
+            url = reader.base_url + path
+            self.hooks.phase("filter", url, time.perf_counter() - start)
+            self.hooks.items(url, self._examined - examined, self._matched - matched)
+            return None
+        if fmt == "index:1.0":
+            return self.sync_index(reader, path, data, "")
+
+        raise TypeError("Unknown format '%s' in '%s'" % (fmt, path))
+
+    @property
+    def records(self):
+        """List of matching Records of each filter set.
+
+        In latest-only mode these are the newest records of each product
+        (or group_by value), sorted newest first. In history mode they are
+        the records of the kept serials, sorted newest first.
+        """
+        if self.history:
+            return [
+                [
+                    record
+                    for _, serial_records in sorted(serials.items(), reverse=True)
+                    for record in serial_records
+                ]
+                for serials in self._serials
+            ]
+        if not self.latest_only:
+            return self._entries
+
+        records = []
+        for latest in self._latest:
+            entries = []
+            for _, product_records in sorted(
+                latest.values(), key=lambda product: product[0], reverse=True
+            ):
+                entries.extend(product_records)
+            records.append(entries)
+
+        return records
+
+    @property
+    def results(self):
+        """List of matching entries of each filter set."""
+        return [[record.as_dict() for record in records] for records in self.records]
+
+    @property
+    def groups(self):
+        """Dictionary of group_by value to newest entries of each filter set."""
+        return [
+            {
+                key: [record.as_dict() for record in records]
+                for key, (_, records) in latest.items()
+            }
+            for latest in self._latest
+        ]
+
+    @property
+    def json_entries(self):
+        """List of matching entries of the first filter set."""
+        return self.results[0]
+
+    def sync_products(self, reader, path=None, src=None, content=None):
+        """Sync a product file, pruned to the products that can match.
+
+        simplestreams filters every item of a product file before it
+        filters the products, so products are rejected here instead.
+
+        Args:
+            reader: mirror reader
+            path: path of the product file
+            src: parsed product file, read from path if None
+            content: raw content of the product file
+        """
+        if src is not None:
+            src = self._prune(src)
+
+        return super(FilterMirror, self).sync_products(reader, path, src, content)
+
+    def _prune(self, src):
+        """Copy the products of a product file that can match.
+
+        simplestreams deletes the rejected items from the tree it syncs,
+        so the kept products are copied down to their items rather than
+        modifying the parsed document. Versions outside of the since and
+        until dates are dropped, and in latest-only and last modes the
+        newest versions come first so that older items are rejected
+        without evaluating the filters.
+
+        Args:
+            src: parsed product file
+
+        Returns:
+            shallow copy of src with the products that can match
+
+        """
+        newest_first = self.latest_only or self.last is not None
+        products = {}
+        for prodname, product in src.get("products", {}).items():
+            if not self._candidates(product, src, prodname):
+                continue
+
+            versions = product.get("versions", {}).items()
+            if newest_first:
+                versions = sorted(
+                    versions, key=lambda version: serial_key(version[0]), reverse=True
+                )
+            products[prodname] = dict(
+                product,
+                versions={
+                    vername: dict(version, items=dict(version.get("items", {})))
+                    for vername, version in versions
+                    if self.filter_version(version, src, None, (prodname, vername))
+                },
+            )
+
+        return dict(src, products=products)
+
+    def load_products(self, path=None, content_id=None):
+        """Load each product.
+
+        Args:
+            path: path the product
+            content_id: ID of product
+
+        Returns:
+            dictionary of products
+
+        """
+        return {"content_id": content_id, "products": {}}
+
+    def filter_index_entry(self, data, src, pedigree):
+        """Filter index entries before their product files are read.
+
+        Records which filter sets apply to the entry so that items of a
+        product file are only checked against those filter sets.
+
+        Args:
+            data: Index entry
+            src: Top level index
+            pedigree: Tuple with the content_id of the entry
+
+        Returns:
+            True if the product file should be synced
+
+        """
+        data = dict(data, content_id=pedigree[0])
+        self._content_sets[pedigree[0]] = [
+            index
+            for index, index_filter in enumerate(self.index_filter_sets)
+            if index_filter.match(data)
+        ]
+
+        return bool(self._content_sets[pedigree[0]])
+
+    def filter_product(self, data, src, target, pedigree):
+        """Reject products from their product level fields alone.
+
+        A product no filter set can match is skipped with all of its
+        versions and items.
+
+        Args:
+            data: Product data
+            src: Top level products
+            target: Top level products
+            pedigree: Tuple with the product name
+
+        Returns:
+            True if the product can match any of the filter sets
+
+        """
+        return bool(self._candidates(data, src, pedigree[0]))
+
+    def keep_product(self, prodname, product, src):
+        """Check a product while its product file is being parsed.
+
+        Only the top level fields parsed before the products are known,
+        a filter on a field missing so far is left to the item level.
+
+        Args:
+            prodname: name of the product
+            product: product data
+            src: top level fields parsed so far
+
+        Returns:
+            True if the product can match any of the filter sets
+
+        """
+        indexes = self._content_sets.get(
+            src.get("content_id"), range(len(self.filter_sets))
+        )
+
+        return any(
+            self.filter_sets[index].for_product(product, src, prodname) is not None
+            for index in indexes
+        )
+
+    def filter_version(self, data, src, target, pedigree):
+        """Reject versions dated outside of the since and until dates.
+
+        The date of a version is the first 8 characters of its name, e.g.
+        20210315 for 20210315.1.
+
+        Args:
+            data: Version data
+            src: Top level products
+            target: Top level products
+            pedigree: Tuple with the product and version names
+
+        Returns:
+            True if the version is in the date range
+
+        """
+        date = pedigree[1][:8]
+        if self.since and date < self.since:
+            return False
+
+        return not self.until or date <= self.until
+
+    def filter_item(self, data, src, target, pedigree):
+        """Filter items based on filter.
+
+        Args:
+            data: Streams data
+            src: Top level products
+            target: Top level products
+            pedigree: No freaking clue
+
+        Returns:
+            True if the item matches any of the filter sets
+
+        """
+        product = src["products"][pedigree[0]]
+        levels = (data, product["versions"][pedigree[1]], product, src)
+
+        candidates = self._candidates(product, src, pedigree[0])
+        if self.latest_only:
+            # simplestreams filters every item of a product file before
+            # inserting any, so the newest serials are tracked here.
+            key = self._latest_key(levels, pedigree)
+            serial = serial_key(pedigree[1])
+            candidates = [
+                (index, predicate)
+                for index, predicate in candidates
+                if serial >= self._newest[index].get(key, serial)
+            ]
+        elif self.last is not None:
+            serial = serial_key(pedigree[1])
+            candidates = [
+                (index, predicate)
+                for index, predicate in candidates
+                if len(self._bounds[index]) < self.last
+                or serial >= self._bounds[index][0]
+            ]
+
+        matched = [
+            index
+            for index, predicate in candidates
+            if predicate.match_item(levels, pedigree)
+        ]
+
+        if self.latest_only:
+            for index in matched:
+                self._newest[index][key] = serial
+        elif self.last is not None:
+            for index in matched:
+                self._bound_serial(self._bounds[index], serial)
+
+        self._examined += 1
+        if matched:
+            # Kept by item until insert_item, which must not rely on
+            # being called right after the filter_item of its item.
+            self._matched_sets[tuple(pedigree)] = matched
+            self._matched += 1
+            return True
+
+        return False
+
+    def _candidates(self, product, src, prodname):
+        """Return the filter sets a product can match.
+
+        Product level filters are evaluated once per product and the
+        result is kept for its remaining items.
+
+        Args:
+            product: product dictionary
+            src: top level products dictionary
+            prodname: name of the product
+
+        Returns:
+            list of filter set index and item level Predicate tuples
+
+        """
+        key = (src.get("content_id"), prodname)
+        if key not in self._product_sets:
+            candidates = []
+            for index in self._content_sets.get(key[0], range(len(self.filter_sets))):
+                predicate = self.filter_sets[index].for_product(product, src, prodname)
+                if predicate is not None:
+                    candidates.append((index, predicate))
+            self._product_sets[key] = candidates
+
+        return self._product_sets[key]
+
+    def insert_item(self, data, src, target, pedigree, contentsource):
+        """Insert item received.
+
+        src and target are top level products:1.0
+        data is src['products'][ped[0]]['versions'][ped[1]]['items'][ped[2]]
+        contentsource is a ContentSource if 'path' exists in data or None
+
+        Args:
+            data: Data from simplestreams
+            src: Top level products
+            target: Top level products
+            pedigree: Still no freaking clue
+            contentsource: If source exists or None
+        """
+        item_url = None
+        if "path" in data and contentsource is not None:
+            item_url = contentsource.url
+        record = Record(src, pedigree, item_url)
+
+        for index in self._matched_sets.pop(tuple(pedigree), ()):
+            if self.history:
+                self._insert_serial(index, serial_key(pedigree[1]), record)
+                continue
+            if not self.latest_only:
+                self._entries[index].append(record)
+                continue
+
+            product = src["products"][pedigree[0]]
+            levels = (data, product["versions"][pedigree[1]], product, src)
+            key = self._latest_key(levels, pedigree)
+            serial = serial_key(pedigree[1])
+            latest = self._latest[index].get(key)
+            if latest is None or serial > latest[0]:
+                self._latest[index][key] = (serial, [record])
+            elif serial == latest[0]:
+                latest[1].append(record)
+
+    def _bound_serial(self, bounds, serial):
+        """Add a matched serial to the min-heap of the last ones of a filter set.
+
+        Once it holds last serials, items of older serials are rejected
+        without evaluating the filters.
+        """
+        if serial in bounds:
+            return
+        if len(bounds) < self.last:
+            heapq.heappush(bounds, serial)
+        elif serial > bounds[0]:
+            heapq.heapreplace(bounds, serial)
+
+    def _insert_serial(self, index, serial, record):
+        """Keep a record if its serial is among the last ones of a filter set.
+
+        The kept serials are a min-heap bounded by last, so the oldest kept
+        serial is dropped with its records when a newer one comes in.
+        """
+        serials = self._serials[index]
+        if serial in serials:
+            serials[serial].append(record)
+            return
+
+        heap = self._heaps[index]
+        if self.last is None or len(heap) < self.last:
+            heapq.heappush(heap, serial)
+        elif heap and serial > heap[0]:
+            del serials[heapq.heapreplace(heap, serial)]
+        else:
+            return
+
+        serials[serial] = [record]
+
+    def _latest_key(self, levels, pedigree):
+        """Key the newest version is tracked by: group_by value or product."""
+        if self.group_by:
+            return lookup(self.group_by, levels, pedigree)
+
+        return pedigree[0]
+
+
+class Record:
+    """Matching item kept as a reference into the parsed product tree.
+
+    The merged dictionary of the item, with the fields inherited from
+    its version, product and the top level, is only built by as_dict().
+    """
+
+    __slots__ = ("src", "pedigree", "item_url")
+
+    def __init__(self, src, pedigree, item_url=None):
+        """Initialize Record class.
+
+        Args:
+            src: Top level products
+            pedigree: Tuple of product, version and item names
+            item_url: URL of the item file, if it has a path
+        """
+        self.src = src
+        self.pedigree = pedigree
+        self.item_url = item_url
+
+    def as_dict(self):
+        """Build the merged dictionary of the item.
+
+        Returns:
+            dictionary as returned by simplestreams products_exdata
+
+        """
+        data = s_util.products_exdata(self.src, self.pedigree)
+        if self.item_url is not None:
+            data["item_url"] = self.item_url
+
+        return data
+
+
+def serial_key(version_name):
+    """Sort key for version names, e.g. 20210315 < 20210315.1 < 20210315.10.
+
+    Args:
+        version_name: version name (serial) of a product version
+
+    Returns:
+        tuple comparing numeric parts as numbers
+
+    """
+    return tuple(
+        (0, int(part)) if part.isdigit() else (1, part)
+        for part in version_name.split(".")
+    )
@@ -0,0 +1,170 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test cache module."""
+import gzip
+import http.server
+import os
+import threading
+
+import pytest
+
+from . import cache as cache_module
+from .cache import Cache, ConnectionPool, cache_dir, download
+
+
+class StreamsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve a fixed body with an ETag and count requests."""
+
+    body = b'{"format": "index:1.0"}'
+    etag = '"abc"'
+    gzip = False
+    hang_up = False
+    requests = []
+    clients = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer with 304 when the client has the current ETag."""
+        self.clients.append(self.client_address)
+        if self.path == "/redirect":
+            self.send_response(301)
+            self.send_header("Location", "/streams/v1/index.json")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = self.body
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        if self.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = self.close_connection or self.hang_up
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Silence request logging."""
+
+
+@pytest.fixture(name="server_url")
+def fixture_server_url():
+    """Run a local HTTP server for the duration of a test."""
+    StreamsHandler.requests = []
+    StreamsHandler.clients = []
+    server = http.server.HTTPServer(("127.0.0.1", 0), StreamsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%s/streams/v1/index.json" % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_cache_dir_snap(monkeypatch):
+    """Test cache directory under the snap."""
+    monkeypatch.setenv("SNAP_USER_COMMON", "/snap/common")
+    assert cache_dir() == "/snap/common/cache"
+
+
+def test_cache_dir_xdg(monkeypatch):
+    """Test cache directory from XDG_CACHE_HOME."""
+    monkeypatch.delenv("SNAP_USER_COMMON", raising=False)
+    monkeypatch.setenv("XDG_CACHE_HOME", "/xdg")
+    assert cache_dir() == "/xdg/ubuntu-cloud-image"
+
+
+def test_fetch_within_ttl(tmp_path, server_url):
+    """Test fresh entries are served without network access."""
+    cache = Cache(str(tmp_path), ttl=3600)
+    assert cache.fetch(server_url) == StreamsHandler.body
+    assert cache.fetch(server_url) == StreamsHandler.body
+    assert StreamsHandler.requests == [None]
+
+
+def test_fetch_revalidate(tmp_path, server_url):
+    """Test stale entries are revalidated with If-None-Match."""
+    cache = Cache(str(tmp_path), ttl=0)
+    assert cache.fetch(server_url) == StreamsHandler.body
+    assert cache.fetch(server_url) == StreamsHandler.body
+    assert StreamsHandler.requests == [None, StreamsHandler.etag]
+
+
+@pytest.mark.parametrize("compressed", [True, False])
+def test_fetch_gzip(tmp_path, server_url, monkeypatch, compressed):
+    """Test content is decompressed and stored compressed."""
+    monkeypatch.setattr(StreamsHandler, "gzip", compressed)
+    cache = Cache(str(tmp_path), ttl=3600)
+    assert cache.fetch(server_url) == StreamsHandler.body
+
+    (data,) = tmp_path.glob("*.data")
+    assert gzip.decompress(data.read_bytes()) == StreamsHandler.body
+    assert Cache(str(tmp_path), ttl=3600).fetch(server_url) == StreamsHandler.body
+
+
+@pytest.fixture(name="pool")
+def fixture_pool(monkeypatch):
+    """Download over a pool of kept-alive connections to HTTP/1.1 servers."""
+    pool = ConnectionPool()
+    monkeypatch.setattr(cache_module, "POOL", pool)
+    monkeypatch.setattr(StreamsHandler, "protocol_version", "HTTP/1.1")
+    yield pool
+    pool.close()
+
+
+def test_download_keep_alive(server_url, pool):
+    """Test downloads from a host reuse a kept-alive connection."""
+    assert download(server_url)[1] == StreamsHandler.body
+    assert download(server_url)[1] == StreamsHandler.body
+    assert len(StreamsHandler.clients) == 2
+    assert len(set(StreamsHandler.clients)) == 1
+
+    pool.close()
+    assert download(server_url)[1] == StreamsHandler.body
+    assert len(set(StreamsHandler.clients)) == 2
+
+
+def test_download_reconnect(server_url, pool, monkeypatch):
+    """Test a kept-alive connection closed by the server is replaced."""
+    monkeypatch.setattr(StreamsHandler, "hang_up", True)
+    assert download(server_url)[1] == StreamsHandler.body
+    assert download(server_url)[1] == StreamsHandler.body
+    assert len(StreamsHandler.clients) == 2
+    assert len(set(StreamsHandler.clients)) == 2
+
+
+def test_download_redirect(server_url, pool):
+    """Test redirects are followed like urlopen does."""
+    url = server_url.replace("/streams/v1/index.json", "/redirect")
+    assert download(url)[1] == StreamsHandler.body
+    assert len(StreamsHandler.clients) == 2
+    assert len(set(StreamsHandler.clients)) == 1
+
+
+def test_result(tmp_path):
+    """Test query results are only served within the TTL."""
+    cache = Cache(str(tmp_path), ttl=3600)
+    assert cache.load_result("query") is None
+    cache.store_result("query", [[{"id": "ami-1"}]])
+    assert cache.load_result("query") == [[{"id": "ami-1"}]]
+    assert cache.load_result("other") is None
+    assert Cache(str(tmp_path), ttl=0).load_result("query") is None
+
+
+def test_verified(tmp_path):
+    """Test verifications are invalidated when the keyring changes."""
+    keyring = tmp_path / "keyring.gpg"
+    keyring.write_bytes(b"key")
+    cache = Cache(str(tmp_path / "cache"))
+
+    assert not cache.is_verified("signed", str(keyring))
+    cache.set_verified("signed", str(keyring))
+    assert cache.is_verified("signed", str(keyring))
+    assert not cache.is_verified("other", str(keyring))
+
+    os.utime(str(keyring), ns=(0, 0))
+    assert not cache.is_verified("signed", str(keyring))
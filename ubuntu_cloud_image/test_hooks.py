@@ -0,0 +1,65 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test hooks module."""
+from .cache import Cache
+from .hooks import Profile
+from .predicate import Predicate
+from .streams import Streams
+from .sync import FilterMirror
+from .testing import products, write_mirror
+
+
+def test_profile_report():
+    """Test phases and counters are summed per file."""
+    profile = Profile()
+    profile.phase("download", "http://mirror/streams/v1/index.sjson", 0.5)
+    profile.phase("download", "http://mirror/streams/v1/index.sjson", 0.25)
+    profile.transferred("http://mirror/streams/v1/index.sjson", 100)
+    profile.items("http://mirror/streams/v1/aws.sjson", 8, 2)
+
+    assert profile.files["http://mirror/streams/v1/index.sjson"]["download"] == 0.75
+    report = profile.report(2048).splitlines()
+    assert report[1].startswith("index.sjson ")
+    assert report[2].startswith("aws.sjson ")
+    assert report[3].split()[-3:] == ["100", "8", "2"]
+    assert report[4] == "peak memory: 2 KiB"
+
+
+class Reader:
+    """Reader serving an already parsed products file."""
+
+    base_url = "http://mirror/"
+
+    @staticmethod
+    def load_document(path):  # pylint: disable=unused-argument
+        """Return the products tree."""
+        return products()
+
+    def source(self, path):
+        """Items of the tree have no path."""
+
+
+def test_filter_mirror_hooks():
+    """Test items examined and matched are reported per product file."""
+    profile = Profile()
+    img_filter = Predicate(["region=us-west-2"])
+    mirror = FilterMirror({"filters": img_filter, "hooks": profile})
+    mirror.sync(Reader(), "streams/v1/aws.sjson")
+
+    counters = profile.files["http://mirror/streams/v1/aws.sjson"]
+    assert (counters["examined"], counters["matched"]) == (8, 4)
+
+
+def test_profile_skips_result_cache(tmp_path):
+    """Test a profiled lookup syncs even when its result is cached."""
+    mirror_url = write_mirror(tmp_path / "mirror", products())
+    cache = Cache(str(tmp_path / "cache"))
+
+    def query(hooks=None):
+        """Look up the newest focal images through the cache."""
+        stream = Streams(mirror_url, None, cache=cache, verify=False, hooks=hooks)
+        return stream.query(["release=focal"], latest_only=True)
+
+    result = query()
+    profile = Profile()
+    assert query(profile) == result
+    assert sum(counters["examined"] for counters in profile.files.values()) == 4
@@ -1,6 +1,10 @@
 # This file is part of ubuntu-cloud-image. See LICENSE file for license info.
 """Test view module."""
+import asyncio
+
 from .image import (
+    CLOUDS,
+    DEFAULT_REGIONS,
     Image,
     AWS,
     AWSChina,
@@ -11,7 +15,11 @@ from .image import (
     LXC,
     MAASv2,
     MAASv3,
+    default_images,
+    search_many,
 )
+from .predicate import compile_filter
+from .testing import Regional, products, write_mirror
 
 
 def test_image():
@@ -21,6 +29,7 @@ def test_image():
     assert not image.daily
     assert not image.minimal
     assert not image.filter
+    assert not image.index_filter
     assert str(image) == "bionic (amd64) image for unknown"
 
 
@@ -67,6 +76,7 @@ def test_aws():
         "root_store=ssd",
         "virt=hvm",
     ]
+    assert image.index_filter == ["content_id~:aws$"]
 
 
 def test_aws_daily():
@@ -143,6 +153,7 @@ def test_aws_china():
         "root_store=ssd",
         "virt=hvm",
     ]
+    assert image.index_filter == ["content_id~:aws-cn$"]
 
 
 def test_aws_govcloud():
@@ -163,6 +174,7 @@ def test_aws_govcloud():
         "root_store=ssd",
         "virt=hvm",
     ]
+    assert image.index_filter == ["content_id~:aws-govcloud$"]
 
 
 def test_azure():
@@ -179,6 +191,7 @@ def test_azure():
         "region=%s" % region,
         "release=%s" % release,
     ]
+    assert image.index_filter == ["content_id~:azure$"]
 
 
 def test_azure_daily():
@@ -213,6 +226,7 @@ def test_gce():
         "region=%s" % region,
         "release=%s" % release,
     ]
+    assert image.index_filter == ["content_id~:gce$"]
 
 
 def test_gce_daily():
@@ -279,6 +293,7 @@ def test_kvm():
         "ftype=disk1.img",
         "release=%s" % release,
     ]
+    assert image.index_filter == ["content_id~:download$"]
 
 
 def test_lxc():
@@ -293,6 +308,7 @@ def test_lxc():
         "ftype=squashfs",
         "release=%s" % release,
     ]
+    assert image.index_filter == ["content_id~:download$"]
 
 
 def test_maasv2():
@@ -309,6 +325,7 @@ def test_maasv2():
         "kflavor=%s" % kernel,
         "release=%s" % release,
     ]
+    assert image.index_filter == ["content_id~:download$"]
 
 
 def test_maasv2_daily():
@@ -341,3 +358,127 @@ def test_maasv3():
         "kflavor=%s" % kernel,
         "release=%s" % release,
     ]
+    assert image.index_filter == ["content_id~:download$"]
+
+
+def test_regional_filter():
+    """Test regional filter drops the region and opens the AWS endpoint."""
+    image = AWS("focal", "amd64", None)
+    (endpoint,) = [item for item in image.regional_filter if "endpoint" in item]
+    assert [item for item in image.regional_filter if item != endpoint] == [
+        "arch=amd64",
+        "release=focal",
+        "root_store=ssd",
+        "virt=hvm",
+    ]
+
+    (_, test) = compile_filter(endpoint)
+    assert test("https://ec2.us-east-1.amazonaws.com")
+    assert test("https://ec2.eu-west-2.amazonaws.com")
+    assert not test("https://ec2.cn-north-1.amazonaws.com.cn")
+    assert not test("https://ec2.us-gov-west-1.amazonaws-govcloud.com")
+
+    (endpoint,) = [
+        item
+        for item in AWSChina("focal", "amd64", None).regional_filter
+        if "endpoint" in item
+    ]
+    (_, test) = compile_filter(endpoint)
+    assert test("https://ec2.cn-north-1.amazonaws.com.cn")
+    assert not test("https://ec2.us-east-1.amazonaws.com")
+
+    azure = Azure("focal", "amd64", None)
+    assert "endpoint=https://management.core.windows.net/" in azure.regional_filter
+    assert not [item for item in azure.regional_filter if "region" in item]
+    gce = GCE("focal", "amd64", None)
+    assert "endpoint=https://www.googleapis.com" in gce.regional_filter
+
+
+def test_default_images():
+    """Test every cloud gets an image with default or given regions."""
+    images = default_images("focal", regions={"aws": "us-west-2"})
+    assert sorted(images) == sorted(CLOUDS)
+    assert images["aws"].region == "us-west-2"
+    assert images["gce"].region == DEFAULT_REGIONS["gce"]
+    assert str(images["kvm"]) == "focal (amd64) image for KVM"
+
+
+def test_default_images_arch():
+    """Test clouds without the requested arch fall back to their default."""
+    images = default_images("focal", "arm64")
+    assert images["aws"].arch == "arm64"
+    assert images["aws-govcloud"].arch == "arm64"
+    assert images["kvm"].arch == "arm64"
+    assert images["azure"].arch == "amd64"
+    assert images["gce"].arch == "amd64"
+
+    images = default_images("focal", "s390x")
+    assert images["maas"].arch == "s390x"
+    assert images["aws"].arch == "amd64"
+
+
+def test_search_many(tmp_path):
+    """Test images are looked up on each of their mirrors."""
+    first = write_mirror(tmp_path / "first", products())
+    second = write_mirror(tmp_path / "second", products("com.ubuntu.cloud:daily:aws"))
+    images = [
+        Regional(first, "focal", "us-east-1"),
+        Regional(second, "bionic", "us-west-2"),
+        Regional(first, "xenial", "us-east-1"),
+    ]
+
+    results = search_many(images, verify=False)
+    assert [result.get("id") for result in results] == [
+        "ami-focal-20210201.1",
+        "ami-bionic-20210201.1",
+        None,
+    ]
+    assert results[1]["content_id"] == "com.ubuntu.cloud:daily:aws"
+
+
+def test_search_many_failed_mirror(tmp_path, caplog):
+    """Test a mirror failing to sync does not stop the other lookups."""
+    mirror_url = write_mirror(tmp_path / "mirror", products())
+    missing = (tmp_path / "missing").as_uri() + "/"
+    images = [
+        Regional(missing, "focal", "us-east-1"),
+        Regional(mirror_url, "focal", "us-east-1"),
+    ]
+
+    results = search_many(images, verify=False)
+    assert results[0]["error"].startswith("%s: " % missing)
+    assert results[1]["id"] == "ami-focal-20210201.1"
+    assert "sync of %s failed" % missing in caplog.text
+
+
+def test_asearch_gather(tmp_path):
+    """Test concurrent asynchronous lookups each get their own image."""
+    mirror_url = write_mirror(tmp_path, products())
+    images = [
+        Regional(mirror_url, "focal", "us-east-1"),
+        Regional(mirror_url, "bionic", "us-west-2"),
+        Regional(mirror_url, "xenial", "us-east-1"),
+        Regional(mirror_url, "focal", "us-west-2"),
+    ]
+
+    async def gather():
+        return await asyncio.gather(*(image.asearch(verify=False) for image in images))
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(gather())
+    finally:
+        loop.close()
+
+    assert [result.get("id") for result in results] == [
+        "ami-focal-20210201.1",
+        "ami-bionic-20210201.1",
+        None,
+        "ami-focal-20210201.1",
+    ]
+    assert [result.get("region") for result in results] == [
+        "us-east-1",
+        "us-west-2",
+        None,
+        "us-west-2",
+    ]
@@ -0,0 +1,126 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test index module."""
+import logging
+
+from .image import AWS
+from .index import Index, parse_filter, sortable_serial
+from .testing import Regional, add_serial, products, write_mirror
+
+MIRROR_URL = "https://cloud-images.ubuntu.com/releases/"
+
+
+def entry(serial, region="us-west-2", release="focal"):
+    """Build a streams entry as returned by Streams.query."""
+    return {
+        "arch": "amd64",
+        "content_id": "com.ubuntu.cloud:released:aws",
+        "endpoint": "https://ec2.%s.amazonaws.com" % region,
+        "id": "ami-%s-%s" % (release, serial),
+        "region": region,
+        "release": release,
+        "root_store": "ssd",
+        "version_name": serial,
+        "virt": "hvm",
+    }
+
+
+def index_of(*entries):
+    """Build an in-memory index of streams entries."""
+    index = Index(":memory:")
+    rows = [
+        Index._row(MIRROR_URL, item)  # pylint: disable=protected-access
+        for item in entries
+    ]
+    index.connection.executemany(
+        "INSERT INTO images VALUES (%s)" % ", ".join("?" * len(rows[0])), rows
+    )
+    index.connection.execute("INSERT INTO mirrors VALUES (?, ?)", (MIRROR_URL, "1"))
+
+    return index
+
+
+def test_sortable_serial():
+    """Test serials sort numerically once converted."""
+    assert sortable_serial("20210315.10") > sortable_serial("20210315.9")
+    assert sortable_serial("20210315.1") > sortable_serial("20210315")
+
+
+def test_parse_filter():
+    """Test only exact matches on indexed columns become SQL."""
+    assert parse_filter(["release=focal", "arch!=amd64", "id~ami-"]) == (
+        {"release": "focal"},
+        ["arch!=amd64", "id~ami-"],
+    )
+
+
+def test_search():
+    """Test the index returns the newest serial matching an image."""
+    index = index_of(
+        entry("20210315.9"),
+        entry("20210315.10"),
+        entry("20210401", region="us-east-1"),
+        entry("20210402", release="bionic"),
+    )
+
+    assert index.search(AWS("focal", "amd64", "us-west-2"))["id"] == (
+        "ami-focal-20210315.10"
+    )
+    assert not index.search(AWS("xenial", "amd64", "us-west-2"))
+
+
+def test_history():
+    """Test the index returns the last serials or a date range, newest first."""
+    index = index_of(
+        entry("20210101"),
+        entry("20210201"),
+        entry("20210201", region="us-east-1"),
+        entry("20210301"),
+    )
+    image = AWS("focal", "amd64", "us-west-2")
+
+    assert [item["version_name"] for item in index.history(image, last=2)] == [
+        "20210301",
+        "20210201",
+    ]
+    assert [
+        item["version_name"]
+        for item in index.history(image, since="20210115", until="20210215")
+    ] == ["20210201"]
+
+
+def test_search_regions():
+    """Test the index returns the newest image of each region."""
+    index = index_of(
+        entry("20210101"),
+        entry("20210201"),
+        entry("20210101", region="us-east-1"),
+        entry("20210301", region="eu-west-1"),
+    )
+    image = AWS("focal", "amd64", None)
+
+    assert {
+        region: item["id"] for region, item in index.search_regions(image).items()
+    } == {
+        "eu-west-1": "ami-focal-20210301",
+        "us-east-1": "ami-focal-20210101",
+        "us-west-2": "ami-focal-20210201",
+    }
+    assert list(index.search_regions(image, ["us-east-1"])) == ["us-east-1"]
+
+
+def test_search_out_of_date(tmp_path, caplog):
+    """Test an index is only used while it matches the streams index."""
+    mirror_url = write_mirror(tmp_path, products(), "1")
+    image = Regional(mirror_url, "focal", "us-east-1")
+    index = Index(":memory:")
+    assert index.build(mirror_url, None, verify=False)
+
+    write_mirror(tmp_path, add_serial(products(), "20210301"), "1")
+    assert index.is_current(mirror_url, None, verify=False)
+    assert image.search(index=index, verify=False)["version_name"] == "20210201.1"
+
+    write_mirror(tmp_path, add_serial(products(), "20210301"), "2")
+    assert not index.is_current(mirror_url, None, verify=False)
+    with caplog.at_level(logging.WARNING):
+        assert image.search(index=index, verify=False)["version_name"] == "20210301"
+    assert "out of date" in caplog.text
@@ -0,0 +1,136 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test main module."""
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+from .__main__ import image_from_query, parse_args, read_queries, run_batch
+from .image import KVM
+
+
+def test_read_queries_ndjson(tmp_path):
+    """Test NDJSON queries, one per line."""
+    queries = tmp_path / "queries.ndjson"
+    queries.write_text(
+        '{"cloud": "kvm", "release": "focal"}\n'
+        "\n"
+        '{"cloud": "lxc", "release": "bionic"}\n'
+    )
+    assert read_queries(str(queries)) == [
+        ({"cloud": "kvm", "release": "focal"}, None),
+        ({"cloud": "lxc", "release": "bionic"}, None),
+    ]
+
+
+def test_read_queries_json(tmp_path):
+    """Test a JSON list of queries."""
+    queries = tmp_path / "queries.json"
+    queries.write_text('[{"cloud": "kvm", "release": "focal"}]')
+    assert read_queries(str(queries)) == [({"cloud": "kvm", "release": "focal"}, None)]
+
+
+def test_run_batch_invalid(tmp_path, caplog):
+    """Test each invalid query is reported on its own line."""
+    queries = tmp_path / "queries.ndjson"
+    queries.write_text(
+        '{"cloud": "kvm", "release"\n'
+        '"str"\n'
+        '{"cloud": "unknown", "release": "focal"}\n'
+        '{"cloud": "kvm", "release": "focal", "region": "x"}\n'
+    )
+    with caplog.at_level(logging.INFO):
+        run_batch(str(queries), {})
+
+    lines = [json.loads(record.getMessage()) for record in caplog.records]
+    assert [line["query"] for line in lines] == [
+        '{"cloud": "kvm", "release"',
+        "str",
+        {"cloud": "unknown", "release": "focal"},
+        {"cloud": "kvm", "release": "focal", "region": "x"},
+    ]
+    assert lines[0]["error"].startswith("invalid JSON: ")
+    assert all(line["error"].startswith("invalid query: ") for line in lines[1:])
+
+
+def test_image_from_query():
+    """Test queries default to amd64 and accept CLI style keys."""
+    image = image_from_query({"cloud": "kvm", "release": "focal", "daily": True})
+    assert isinstance(image, KVM)
+    assert image.arch == "amd64"
+    assert image.daily
+    image = image_from_query({"cloud": "kvm", "release": "focal", "daily": "0"})
+    assert not image.daily
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["aws", "focal", "us-east-1", "--all-regions"],
+        ["aws", "focal", "--all-regions", "us-east-1"],
+    ],
+)
+def test_all_regions_exclusive(monkeypatch, capsys, argv):
+    """Test --all-regions cannot be combined with regions."""
+    monkeypatch.setattr(sys, "argv", ["ubuntu-cloud-image"] + argv)
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert "error:" in capsys.readouterr().err
+
+
+def test_all_regions(monkeypatch):
+    """Test regions and --all-regions are each accepted alone."""
+    monkeypatch.setattr(
+        sys, "argv", ["ubuntu-cloud-image", "aws", "focal", "--all-regions"]
+    )
+    args = parse_args()
+    assert args.all_regions and args.region == []
+
+    monkeypatch.setattr(
+        sys, "argv", ["ubuntu-cloud-image", "aws", "focal", "us-east-1"]
+    )
+    args = parse_args()
+    assert not args.all_regions and args.region == ["us-east-1"]
+
+
+def run_python(code):
+    """Run code in a new interpreter with the package importable."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def test_help_does_not_import_simplestreams():
+    """Test --help returns without importing simplestreams."""
+    run_python(
+        "import sys\n"
+        "from ubuntu_cloud_image.__main__ import launch\n"
+        "sys.argv = ['ubuntu-cloud-image', '--help']\n"
+        "try:\n"
+        "    launch()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "assert 'simplestreams' not in sys.modules\n"
+    )
+
+
+def test_cached_result_does_not_import_simplestreams(tmp_path):
+    """Test lookups answered by the result cache do not sync."""
+    run_python(
+        "import sys\n"
+        "from ubuntu_cloud_image.cache import Cache\n"
+        "from ubuntu_cloud_image.image import KVM\n"
+        "cache = Cache(%r)\n"
+        "cache.load_result = lambda key: [[{'id': 'cached'}]]\n"
+        "assert KVM('focal', 'amd64').search(cache=cache) == {'id': 'cached'}\n"
+        "assert 'simplestreams' not in sys.modules\n" % str(tmp_path)
+    )
@@ -0,0 +1,38 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test parse module."""
+import json
+
+import pytest
+
+from .parse import load_products
+from .testing import products
+
+
+def test_load_products():
+    """Test rejected products are left out of the document."""
+    content = json.dumps(products(), indent=1)
+
+    def keep_product(name, product, src):
+        """Keep focal, checking the top level parsed so far."""
+        assert src["content_id"] == "com.ubuntu.cloud:released:aws"
+        assert "versions" in product
+        return name.endswith(":20.04:amd64")
+
+    data = load_products(content, keep_product)
+    expected = products()
+    del expected["products"]["com.ubuntu.cloud:server:18.04:amd64"]
+    assert data == expected
+
+
+def test_load_products_all():
+    """Test keeping every product parses like json.loads."""
+    content = json.dumps({"a": [1, {"b": None}], "products": {}, "c": "}"})
+    assert load_products(content, lambda *args: True) == json.loads(content)
+    assert load_products(" {} ", lambda *args: True) == {}
+
+
+@pytest.mark.parametrize("content", ["[]", '{"a": 1} x', '{"a" 1}', "{1: 2}"])
+def test_load_products_invalid(content):
+    """Test invalid documents raise ValueError."""
+    with pytest.raises(ValueError):
+        load_products(content, lambda *args: True)
@@ -0,0 +1,52 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test predicate module."""
+import pytest
+
+from .predicate import Predicate, lookup
+
+SRC = {"content_id": "com.ubuntu.cloud:released:aws", "format": "products:1.0"}
+PRODUCT = {"arch": "amd64", "release": "focal", "versions": {}}
+VERSION = {"label": "release", "items": {}}
+ITEM = {"id": "ami-1234", "region": "us-east-1", "root_store": "ssd"}
+LEVELS = (ITEM, VERSION, PRODUCT, SRC)
+PEDIGREE = ("com.ubuntu.cloud:server:20.04:amd64", "20210315", "usee1ssd")
+
+
+def test_lookup():
+    """Test values resolve from the most specific level."""
+    assert lookup("region", LEVELS, PEDIGREE) == "us-east-1"
+    assert lookup("release", LEVELS, PEDIGREE) == "focal"
+    assert lookup("content_id", LEVELS, PEDIGREE) == SRC["content_id"]
+    assert lookup("version_name", LEVELS, PEDIGREE) == "20210315"
+    assert lookup("versions", LEVELS, PEDIGREE) == ""
+    assert lookup("missing", LEVELS, PEDIGREE) == ""
+
+
+@pytest.mark.parametrize(
+    "img_filter, expected",
+    [
+        (["region=us-east-1", "release=focal"], True),
+        (["region=us-west-2"], False),
+        (["region!=us-west-2"], True),
+        (["id~^ami-"], True),
+        (["id!~^ami-"], False),
+        (["kflavor="], True),
+    ],
+)
+def test_match_item(img_filter, expected):
+    """Test item matching for each operator."""
+    assert Predicate(img_filter).match_item(LEVELS, PEDIGREE) is expected
+
+
+def test_invalid_filter():
+    """Test unparsable filters raise."""
+    with pytest.raises(ValueError):
+        Predicate(["=value"])
+
+
+def test_for_product():
+    """Test product level filters are decided once per product."""
+    predicate = Predicate(["release=focal", "region=us-east-1"])
+    remaining = predicate.for_product(PRODUCT, SRC, PEDIGREE[0])
+    assert [key for key, _ in remaining.tests] == ["region"]
+    assert Predicate(["release=bionic"]).for_product(PRODUCT, SRC, PEDIGREE[0]) is None
@@ -0,0 +1,166 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test server module."""
+import threading
+import urllib.error
+
+import pytest
+
+from . import client
+from .image import AWS, CLOUDS
+from .server import Catalogue, RequestHandler, Server, image_from_query
+from .testing import Regional, add_serial, products, write_mirror
+
+
+def cloud_of(mirror_url):
+    """Create a cloud of the CLI whose images are in the test mirror."""
+
+    class Cloud(Regional):
+        """Image of the test mirror created like the CLI clouds."""
+
+        def __init__(self, release, arch, region, daily=False):
+            """Initialize Cloud image pointing at the test mirror."""
+            super().__init__(mirror_url, release, region)
+            self.arch = arch
+            self.daily = daily
+
+    return Cloud
+
+
+@pytest.fixture(name="server_url")
+def fixture_server_url(tmp_path, monkeypatch):
+    """Run a query daemon of a test cloud for the duration of a test."""
+    monkeypatch.setitem(CLOUDS, "test", cloud_of(write_mirror(tmp_path, products())))
+    catalogue = Catalogue(verify=False)
+    handler = type("Handler", (RequestHandler,), {"catalogue": catalogue})
+    server = Server(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%s" % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_image_from_query():
+    """Test query string parameters create the matching image."""
+    image = image_from_query(
+        "aws",
+        {
+            "release": "focal",
+            "arch": "arm64",
+            "region": "us-east-1",
+            "root-store": "instance",
+            "daily": "1",
+        },
+    )
+    assert isinstance(image, AWS)
+    assert image.daily
+    assert image.root_store == "instance"
+    assert str(image) == "daily focal (arm64) image for AWS (us-east-1)"
+
+
+def test_image_from_query_invalid():
+    """Test unknown clouds and arguments raise."""
+    with pytest.raises(KeyError):
+        image_from_query("unknown", {"release": "focal", "arch": "amd64"})
+    with pytest.raises(TypeError):
+        image_from_query("kvm", {"release": "focal", "arch": "amd64", "region": "x"})
+
+
+def test_catalogue_refresh(tmp_path):
+    """Test the catalogue indexes a mirror once and refreshes it."""
+    mirror_url = write_mirror(tmp_path, products(), "1")
+    image = Regional(mirror_url, "focal", "us-east-1")
+    catalogue = Catalogue(refresh=0.01, verify=False)
+
+    assert catalogue.search(image)["version_name"] == "20210201.1"
+    assert catalogue.index.mirrors() == [mirror_url]
+
+    write_mirror(tmp_path, add_serial(products(), "20210301"), "2")
+    assert catalogue.search(image)["version_name"] == "20210201.1"
+
+    catalogue.start()
+    try:
+        for _ in range(500):
+            if catalogue.search(image)["version_name"] == "20210301":
+                break
+            threading.Event().wait(0.01)
+    finally:
+        catalogue.stop()
+    assert catalogue.search(image)["version_name"] == "20210301"
+
+
+def test_catalogue_search_all(tmp_path):
+    """Test a failing mirror only fails its own clouds."""
+    images = {
+        "test": Regional(write_mirror(tmp_path, products()), "focal", "us-east-1"),
+        "down": Regional((tmp_path / "missing").as_uri() + "/", "focal", "x"),
+    }
+
+    result = Catalogue(verify=False).search_all(images)
+    assert result["test"]["id"] == "ami-focal-20210201.1"
+    assert result["down"]["error"].startswith(images["down"].mirror_url)
+
+
+def test_request_latest(server_url):
+    """Test the daemon answers latest lookups."""
+    result = client.query(
+        server_url, "test", {"release": "focal", "region": "us-east-1"}
+    )
+    assert result["id"] == "ami-focal-20210201.1"
+
+
+def test_request_history(server_url):
+    """Test the daemon answers the last serials and date ranges."""
+    args = {"release": "focal", "region": ["us-west-2"], "last": 2}
+    result = client.query(server_url, "test", args)
+    assert [entry["version_name"] for entry in result] == ["20210201.1", "20210101"]
+
+    args = {"release": "focal", "region": "us-west-2", "since": "2021-01-15"}
+    result = client.query(server_url, "test", args)
+    assert [entry["version_name"] for entry in result] == ["20210201.1"]
+
+
+def test_request_regions(server_url):
+    """Test the daemon answers several regions and all regions."""
+    args = {"release": "bionic", "region": ["us-east-1", "us-west-2"]}
+    result = client.query(server_url, "test", args)
+    assert sorted(result) == ["us-east-1", "us-west-2"]
+    assert result["us-west-2"]["id"] == "ami-bionic-20210201.1"
+
+    args = {"release": "bionic", "region": [], "all_regions": True}
+    assert client.query(server_url, "test", args) == result
+
+
+def test_request_all(server_url, monkeypatch):
+    """Test the daemon answers the latest image of every cloud."""
+    monkeypatch.setattr(
+        "ubuntu_cloud_image.server.default_images",
+        lambda release, arch, regions: {
+            name: CLOUDS["test"](release, arch, region)
+            for name, region in regions.items()
+        },
+    )
+
+    args = {"release": "focal", "region": ["aws=us-east-1", "gce=us-west-2"]}
+    result = client.query(server_url, "all", args)
+    assert result["aws"]["id"] == result["gce"]["id"] == "ami-focal-20210201.1"
+
+
+@pytest.mark.parametrize(
+    "command, args, code",
+    [
+        ("unknown", {"release": "focal"}, 404),
+        ("test", {"release": "focal"}, 400),
+        ("test", {"release": "focal", "region": "x", "root-store": "ssd"}, 400),
+        ("test", {"release": "focal", "region": "x", "last": "two"}, 400),
+        ("test", {"release": "focal", "region": "x", "since": "2021-13-01"}, 400),
+        ("test", {"release": "focal", "region": ["x", "y"], "last": 1}, 400),
+        ("all", {"release": "focal", "region": ["us-east-1"]}, 400),
+    ],
+)
+def test_request_invalid(server_url, command, args, code):
+    """Test invalid queries are rejected with a message."""
+    with pytest.raises(urllib.error.HTTPError) as error:
+        client.query(server_url, command, args)
+    assert error.value.code == code
+    assert error.value.read()
@@ -0,0 +1,491 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test sync module."""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from . import sync as sync_module
+from .cache import Cache
+from .predicate import Predicate
+from .streams import Streams, history_date
+from .sync import FilterMirror, StreamsMirrorReader, load_mapped, serial_key
+from .testing import products, write_mirror
+
+
+def sync(config, tree=None):
+    """Sync a products tree into a FilterMirror with the given config."""
+    mirror = FilterMirror(config)
+    mirror.sync_products(None, src=tree or products(), content="")
+    return mirror
+
+
+def test_filter_single():
+    """Test a single filter returns every matching version."""
+    mirror = sync({"filters": Predicate(["release=focal", "region=us-east-1"])})
+    assert sorted(entry["version_name"] for entry in mirror.json_entries) == [
+        "20210101",
+        "20210201.1",
+    ]
+
+
+def test_prune_products():
+    """Test items of rejected products are never filtered nor deleted."""
+    tree = products()
+    original = json.dumps(tree, sort_keys=True)
+    mirror = sync({"filters": Predicate(["release=focal", "region=us-east-1"])}, tree)
+    assert len(mirror.json_entries) == 2
+    assert mirror._examined == 4  # pylint: disable=protected-access
+    assert json.dumps(tree, sort_keys=True) == original
+
+
+def test_filter_sets():
+    """Test items are routed to every matching filter set."""
+    mirror = sync(
+        {
+            "filter_sets": [
+                Predicate(["release=focal", "region=us-east-1"]),
+                Predicate(["release=bionic"]),
+                Predicate(["release=xenial"]),
+            ]
+        }
+    )
+    assert len(mirror.results[0]) == 2
+    assert len(mirror.results[1]) == 4
+    assert not mirror.results[2]
+
+
+def test_insert_after_other_filter():
+    """Test items are inserted into their own filter sets out of order."""
+    tree = products()
+    mirror = FilterMirror(
+        {
+            "filter_sets": [
+                Predicate(["region=us-east-1"]),
+                Predicate(["region=us-west-2"]),
+            ]
+        }
+    )
+    versions = tree["products"]["com.ubuntu.cloud:server:20.04:amd64"]["versions"]
+    items = versions["20210201.1"]["items"]
+    pedigrees = [
+        ("com.ubuntu.cloud:server:20.04:amd64", "20210201.1", region)
+        for region in ("us-east-1", "us-west-2")
+    ]
+
+    for pedigree in pedigrees:
+        assert mirror.filter_item(items[pedigree[2]], tree, None, pedigree)
+    for pedigree in pedigrees:
+        mirror.insert_item(items[pedigree[2]], tree, None, pedigree, None)
+
+    assert [[entry["region"] for entry in entries] for entries in mirror.results] == [
+        ["us-east-1"],
+        ["us-west-2"],
+    ]
+
+
+def test_latest_only():
+    """Test latest-only mode keeps the newest serial of each product."""
+    mirror = sync({"filters": Predicate(["region=us-east-1"]), "latest_only": True})
+    assert sorted(entry["id"] for entry in mirror.json_entries) == [
+        "ami-bionic-20210201.1",
+        "ami-focal-20210201.1",
+    ]
+
+
+def test_latest_only_newest_first():
+    """Test older serials filtered after the newest one are not matched."""
+    tree = products()
+    for product in tree["products"].values():
+        product["versions"] = dict(reversed(list(product["versions"].items())))
+
+    mirror = sync(
+        {"filters": Predicate(["region=us-east-1"]), "latest_only": True}, tree
+    )
+    assert sorted(entry["id"] for entry in mirror.json_entries) == [
+        "ami-bionic-20210201.1",
+        "ami-focal-20210201.1",
+    ]
+    assert mirror._matched == 2  # pylint: disable=protected-access
+
+
+def test_serial_key():
+    """Test serials sort numerically."""
+    serials = ["20210315.10", "20210315", "20210315.9", "20210301.1"]
+    assert sorted(serials, key=serial_key) == [
+        "20210301.1",
+        "20210315",
+        "20210315.9",
+        "20210315.10",
+    ]
+
+
+def test_group_by():
+    """Test group_by keeps the newest entry of each region."""
+    mirror = sync({"filters": Predicate(["release=focal"]), "group_by": "region"})
+    assert {
+        region: [entry["id"] for entry in entries]
+        for region, entries in mirror.groups[0].items()
+    } == {
+        "us-east-1": ["ami-focal-20210201.1"],
+        "us-west-2": ["ami-focal-20210201.1"],
+    }
+
+
+def test_filter_product():
+    """Test products are rejected from product level fields."""
+    mirror = FilterMirror(
+        {"filter_sets": [Predicate(["release=focal"]), Predicate(["arch=arm64"])]}
+    )
+    tree = products()
+    assert mirror.filter_product(
+        tree["products"]["com.ubuntu.cloud:server:20.04:amd64"],
+        tree,
+        None,
+        ("com.ubuntu.cloud:server:20.04:amd64",),
+    )
+    assert not mirror.filter_product(
+        tree["products"]["com.ubuntu.cloud:server:18.04:amd64"],
+        tree,
+        None,
+        ("com.ubuntu.cloud:server:18.04:amd64",),
+    )
+
+
+def test_records():
+    """Test records only reference the tree until converted."""
+    mirror = sync(
+        {
+            "filters": Predicate(["release=focal", "region=us-west-2"]),
+            "latest_only": True,
+        }
+    )
+    (record,) = mirror.records[0]
+    assert record.pedigree == (
+        "com.ubuntu.cloud:server:20.04:amd64",
+        "20210201.1",
+        "us-west-2",
+    )
+    assert not hasattr(record, "__dict__")
+    assert record.as_dict()["id"] == "ami-focal-20210201.1"
+    assert record.as_dict()["release"] == "focal"
+
+
+def test_load_document_incremental(tmp_path):
+    """Test tagged documents are served parsed until their tag changes."""
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / "products.json").write_text(json.dumps(products()))
+    cache = Cache(str(tmp_path / "cache"))
+
+    def reader(tag):
+        """Create a reader tagging the products file."""
+        s_mirror = StreamsMirrorReader(
+            mirror.as_uri(), policy=lambda content, path: content, cache=cache
+        )
+        s_mirror.tags["products.json"] = tag
+        return s_mirror
+
+    assert reader("1").load_document("products.json") == products()
+
+    (mirror / "products.json").write_text(json.dumps(products("changed")))
+    assert reader("1").load_document("products.json") == products()
+    assert reader("2").load_document("products.json") == products("changed")
+
+
+def test_load_mapped(tmp_path):
+    """Test files are read through a memory map, empty ones included."""
+    (tmp_path / "index.json").write_text('{"format": "index:1.0"}')
+    (tmp_path / "empty.json").write_text("")
+    assert load_mapped(str(tmp_path / "index.json")) == '{"format": "index:1.0"}'
+    assert load_mapped(str(tmp_path / "empty.json")) == ""
+
+
+def test_snapshot(tmp_path):
+    """Test a mirror is copied once and then queried from the copy."""
+    tree = products()
+    versions = tree["products"]["com.ubuntu.cloud:server:20.04:amd64"]["versions"]
+    versions["20210201.1"]["items"]["us-east-1"]["path"] = "server/focal.img"
+    mirror = tmp_path / "mirror" / "releases"
+    mirror_url = write_mirror(mirror, tree)
+    mirror_dir = str(tmp_path / "copy")
+
+    assert Streams(mirror_url, None, verify=False).snapshot(mirror_dir) == 1
+    assert Streams(mirror_url, None, verify=False).snapshot(mirror_dir) == 0
+
+    (mirror / "streams" / "v1" / "aws.sjson").unlink()
+    stream = Streams(mirror_url, None, verify=False, mirror_dir=mirror_dir)
+    result = stream.query(["release=focal", "region=us-east-1"], latest_only=True)
+    assert [entry["id"] for entry in result] == ["ami-focal-20210201.1"]
+    assert result[0]["item_url"] == mirror_url + "server/focal.img"
+
+
+def test_snapshot_verified(tmp_path, signer):
+    """Test the copies of a signed mirror are verified when queried."""
+    (sign, keyring) = signer
+    mirror = tmp_path / "mirror"
+    mirror_url = write_mirror(mirror, products())
+    for name in ("index.sjson", "aws.sjson"):
+        path = mirror / "streams" / "v1" / name
+        path.write_text(sign(path.read_text()))
+    mirror_dir = str(tmp_path / "copy")
+    assert Streams(mirror_url, keyring).snapshot(mirror_dir) == 1
+
+    stream = Streams(mirror_url, keyring, mirror_dir=mirror_dir)
+    assert len(stream.query(["release=focal"])) == 4
+
+    (copy,) = (tmp_path / "copy").rglob("aws.sjson")
+    copy.write_text(copy.read_text().replace("ami-focal", "ami-forged"))
+    with pytest.raises(subprocess.CalledProcessError):
+        Streams(mirror_url, keyring, mirror_dir=mirror_dir).query(["release=focal"])
+
+
+def test_history_last():
+    """Test the last serials are kept with all of their matching items."""
+    tree = products()
+    versions = tree["products"]["com.ubuntu.cloud:server:20.04:amd64"]["versions"]
+    versions["20210301"] = versions["20210101"]
+    mirror = sync({"filters": Predicate(["release=focal"]), "last": 2}, tree)
+    assert [
+        (entry["version_name"], entry["region"]) for entry in mirror.json_entries
+    ] == [
+        ("20210301", "us-east-1"),
+        ("20210301", "us-west-2"),
+        ("20210201.1", "us-east-1"),
+        ("20210201.1", "us-west-2"),
+    ]
+
+
+def test_history_last_newest_first():
+    """Test items older than the last serials are not matched."""
+    tree = products()
+    versions = tree["products"]["com.ubuntu.cloud:server:20.04:amd64"]["versions"]
+    versions = dict(reversed(list(versions.items())))
+    tree["products"]["com.ubuntu.cloud:server:20.04:amd64"]["versions"] = versions
+
+    mirror = sync({"filters": Predicate(["release=focal"]), "last": 1}, tree)
+    assert [entry["id"] for entry in mirror.json_entries] == [
+        "ami-focal-20210201.1",
+        "ami-focal-20210201.1",
+    ]
+    assert mirror._matched == 2  # pylint: disable=protected-access
+
+
+def test_history_dates():
+    """Test serials are limited to the since and until dates."""
+    mirror = sync(
+        {
+            "filters": Predicate(["region=us-east-1"]),
+            "since": "2021-01-15",
+            "until": "20210201",
+        }
+    )
+    assert [entry["id"] for entry in mirror.json_entries] == [
+        "ami-bionic-20210201.1",
+        "ami-focal-20210201.1",
+    ]
+
+
+def test_aquery_options(tmp_path):
+    """Test the query options are passed through the asynchronous query."""
+    stream = Streams(write_mirror(tmp_path, products()), None, verify=False)
+
+    async def gather():
+        return await asyncio.gather(
+            stream.aquery(["release=focal"], group_by="region"),
+            stream.aquery(["release=focal", "region=us-east-1"], last=2),
+            stream.aquery(["region=us-west-2"], since="2021-01-15"),
+        )
+
+    loop = asyncio.new_event_loop()
+    try:
+        (regions, last, since) = loop.run_until_complete(gather())
+    finally:
+        loop.close()
+
+    assert sorted(regions) == ["us-east-1", "us-west-2"]
+    assert regions["us-west-2"][0]["id"] == "ami-focal-20210201.1"
+    assert [entry["version_name"] for entry in last] == ["20210201.1", "20210101"]
+    assert [entry["id"] for entry in since] == [
+        "ami-bionic-20210201.1",
+        "ami-focal-20210201.1",
+    ]
+
+
+def test_keyring_change(tmp_path, monkeypatch):
+    """Test parsed product files are verified again when the keyring changes."""
+    mirror_url = write_mirror(tmp_path / "mirror", products())
+    keyring = tmp_path / "keyring.gpg"
+    keyring.write_bytes(b"")
+    cache = Cache(str(tmp_path / "cache"))
+
+    verified = []
+
+    def read_signed(_, content):
+        """Record the verified files, which are not signed in this test."""
+        verified.append("products" if content.startswith('{"content_id"') else "index")
+        return content
+
+    monkeypatch.setattr(Streams, "_read_signed", read_signed)
+
+    def query():
+        """Query the mirror and return the files verified meanwhile."""
+        del verified[:]
+        Streams(mirror_url, str(keyring), cache=cache).query(["release=focal"])
+        return sorted(verified)
+
+    assert query() == ["index", "products"]
+    assert query() == ["index"]
+
+    mtime = keyring.stat().st_mtime_ns + 10**9
+    os.utime(str(keyring), ns=(mtime, mtime))
+    assert query() == ["index", "products"]
+
+
+@pytest.fixture
+def signer(tmp_path):
+    """Clearsign with a throwaway GPG key, giving the sign function and keyring."""
+    if not shutil.which("gpg"):
+        pytest.skip("gpg is not installed")
+
+    home = tmp_path / "gnupg"
+    home.mkdir(mode=0o700)
+
+    def gpg(*args, content=None):
+        """Run gpg in the throwaway home directory and return its output."""
+        return subprocess.run(
+            ["gpg", "--batch", "--homedir", str(home)] + list(args),
+            input=content,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        ).stdout
+
+    gpg(
+        "--pinentry-mode",
+        "loopback",
+        "--passphrase",
+        "",
+        "--quick-gen-key",
+        "Test Streams <test@example.com>",
+        "ed25519",
+        "sign",
+        "never",
+    )
+    keyring = tmp_path / "keyring.gpg"
+    keyring.write_bytes(gpg("--export"))
+
+    yield (
+        lambda content: gpg("--clearsign", content=content.encode()).decode(),
+        str(keyring),
+    )
+
+    subprocess.run(
+        ["gpgconf", "--homedir", str(home), "--kill", "all"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def test_verified_cache(tmp_path, monkeypatch, signer):
+    """Test signed files verified once are read again without gpg."""
+    (sign, keyring) = signer
+    mirror_url = write_mirror(tmp_path / "mirror", products())
+    for name in ("index.sjson", "aws.sjson"):
+        path = tmp_path / "mirror" / "streams" / "v1" / name
+        path.write_text(sign(path.read_text()))
+    cache = Cache(str(tmp_path / "cache"))
+
+    reads = []
+    read_signed = sync_module.s_util.read_signed
+
+    def record(content, keyring=None, checked=True):
+        """Record whether each read checks the signature."""
+        reads.append(checked)
+        return read_signed(content, keyring=keyring, checked=checked)
+
+    monkeypatch.setattr(sync_module.s_util, "read_signed", record)
+
+    def query():
+        """Query the mirror and return the number of signature checks."""
+        del reads[:]
+        result = Streams(mirror_url, keyring, cache=cache).query(["release=focal"])
+        return (sum(reads), len(result))
+
+    assert query() == (2, 4)
+    assert query() == (0, 4)
+
+
+def test_prefetch(tmp_path, monkeypatch):
+    """Test product files are parsed concurrently once and reused by the sync."""
+    mirror_url = write_mirror(tmp_path, products())
+    daily = products("com.ubuntu.cloud:daily:aws")
+    (tmp_path / "streams" / "v1" / "daily.sjson").write_text(json.dumps(daily))
+    index_path = tmp_path / "streams" / "v1" / "index.sjson"
+    index = json.loads(index_path.read_text())
+    index["index"][daily["content_id"]] = dict(
+        index["index"]["com.ubuntu.cloud:released:aws"], path="streams/v1/daily.sjson"
+    )
+    index_path.write_text(json.dumps(index))
+
+    calls = {"prefetch": [], "read_json": [], "load_content": []}
+
+    def record(name, function):
+        """Wrap a function to record the last argument of its calls."""
+
+        def wrapper(*args, **kwargs):
+            calls[name].append(args[-1])
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(
+        StreamsMirrorReader,
+        "prefetch",
+        record("prefetch", StreamsMirrorReader.prefetch),
+    )
+    monkeypatch.setattr(
+        StreamsMirrorReader,
+        "read_json",
+        record("read_json", StreamsMirrorReader.read_json),
+    )
+    monkeypatch.setattr(
+        sync_module.s_util,
+        "load_content",
+        record("load_content", sync_module.s_util.load_content),
+    )
+
+    results = Streams(mirror_url, None, workers=2, verify=False).query(
+        ["release=focal"]
+    )
+
+    assert calls["prefetch"] == [2]
+    assert sorted(calls["read_json"]) == [
+        "streams/v1/aws.sjson",
+        "streams/v1/daily.sjson",
+        "streams/v1/index.sjson",
+    ]
+    assert len(calls["load_content"]) == 3
+    assert sorted({entry["content_id"] for entry in results}) == [
+        "com.ubuntu.cloud:daily:aws",
+        "com.ubuntu.cloud:released:aws",
+    ]
+    assert len(results) == 8
+
+
+@pytest.mark.parametrize("value", ["2021-2-1", "garbage", "20211301", "2021-0201"])
+def test_history_date_invalid(value):
+    """Test history dates are rejected unless YYYY-MM-DD or YYYYMMDD."""
+    with pytest.raises(ValueError):
+        history_date(value)
+    with pytest.raises(ValueError):
+        Streams("file:///nonexistent/", None).query([], since=value)
+
+
+def test_history_date():
+    """Test history dates are normalized to YYYYMMDD."""
+    assert history_date("2021-02-01") == "20210201"
+    assert history_date("20210201") == "20210201"
@@ -0,0 +1,42 @@
+# This file is part of ubuntu-cloud-image. See LICENSE file for license info.
+"""Test watch module."""
+from .testing import Regional, add_serial, products, write_mirror
+from .watch import Watcher
+
+
+def test_poll(tmp_path):
+    """Test events are only reported for new serials of a changed index."""
+    mirror_url = write_mirror(tmp_path, products(), "1")
+    watcher = Watcher(
+        [
+            Regional(mirror_url, "focal", "us-east-1"),
+            Regional(mirror_url, "focal", "us-west-2"),
+        ],
+        verify=False,
+    )
+
+    assert not watcher.poll()
+    assert watcher.versions == ["20210201.1", "20210201.1"]
+
+    write_mirror(tmp_path, add_serial(products(), "20210301"), "1")
+    assert not watcher.poll()
+
+    write_mirror(tmp_path, add_serial(products(), "20210301"), "2")
+    (event,) = watcher.poll()
+    assert event["previous"] == "20210201.1"
+    assert event["version_name"] == "20210301"
+    assert event["result"]["id"] == "ami-focal-20210301"
+    assert watcher.versions == ["20210301", "20210201.1"]
+
+
+def test_run(tmp_path):
+    """Test run polls the given number of times."""
+    mirror_url = write_mirror(tmp_path, products())
+    watcher = Watcher(
+        [Regional(mirror_url, "focal", "us-east-1")], interval=0, jitter=0, verify=False
+    )
+
+    events = []
+    watcher.run(events.append, polls=2)
+    assert not events
+    assert watcher.versions == ["20210201.1"]
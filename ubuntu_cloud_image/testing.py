@@ -0,0 +1,73 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Test mirrors and images shared by the tests."""
+import json
+
+from .image import Image
+
+
+def products(content_id="com.ubuntu.cloud:released:aws"):
+    """Build a small products tree with two releases and regions."""
+    tree = {"content_id": content_id, "format": "products:1.0", "products": {}}
+    for release, version in (("bionic", "18.04"), ("focal", "20.04")):
+        versions = {}
+        for serial in ("20210101", "20210201.1"):
+            versions[serial] = {
+                "items": {
+                    region: {"id": "ami-%s-%s" % (release, serial), "region": region}
+                    for region in ("us-east-1", "us-west-2")
+                }
+            }
+        tree["products"]["com.ubuntu.cloud:server:%s:amd64" % version] = {
+            "arch": "amd64",
+            "release": release,
+            "versions": versions,
+        }
+
+    return tree
+
+
+def add_serial(tree, serial):
+    """Add a serial to the focal product of a products tree."""
+    versions = tree["products"]["com.ubuntu.cloud:server:20.04:amd64"]["versions"]
+    versions[serial] = {
+        "items": {"us-east-1": {"id": "ami-focal-%s" % serial, "region": "us-east-1"}}
+    }
+    return tree
+
+
+def write_mirror(path, tree, updated="Mon, 01 Mar 2021 00:00:00 +0000"):
+    """Write an unsigned mirror of a products tree and return its URL."""
+    streams = path / "streams" / "v1"
+    streams.mkdir(parents=True, exist_ok=True)
+    (streams / "aws.sjson").write_text(json.dumps(tree))
+    index = {
+        "format": "index:1.0",
+        "updated": updated,
+        "index": {
+            tree["content_id"]: {
+                "format": "products:1.0",
+                "path": "streams/v1/aws.sjson",
+                "updated": updated,
+            }
+        },
+    }
+    (streams / "index.sjson").write_text(json.dumps(index))
+
+    return path.as_uri() + "/"
+
+
+class Regional(Image):
+    """Image of the test mirror in a region."""
+
+    content_id = "aws"
+
+    def __init__(self, mirror_url, release, region):
+        """Initialize Regional image pointing at the test mirror."""
+        super().__init__(release, "amd64")
+        self.mirror_url = mirror_url
+        self.region = region
+
+    @property
+    def filter(self):
+        """Create filter."""
+        return ["release=%s" % self.release, "region=%s" % self.region]
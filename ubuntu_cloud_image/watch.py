@@ -0,0 +1,131 @@
+# This file is part of ubuntu-cloud-image. See LICENSE for license information.
+"""Change feed of the new serials of watched images."""
+
+import logging
+import random
+import threading
+
+from .streams import Streams
+
+DEFAULT_INTERVAL = 300
+DEFAULT_JITTER = 30
+
+
+class Watcher:
+    """Poll mirrors and report the images whose latest serial changed.
+
+    Each poll reads the streams index of every watched mirror and only
+    syncs the mirrors whose index updated timestamp changed, so with a
+    cache that revalidates on every poll (a TTL of 0) a quiet mirror costs
+    a single conditional request.
+    """
+
+    def __init__(
+        self, images, interval=DEFAULT_INTERVAL, jitter=DEFAULT_JITTER, **kwargs
+    ):
+        """Initialize Watcher class.
+
+        Args:
+            images: list of Image instances to watch
+            interval: seconds between polls
+            jitter: maximum random seconds added to each interval
+            kwargs: additional arguments passed to Streams (e.g. cache)
+        """
+        self._log = logging.getLogger(__name__)
+
+        self.images = images
+        self.interval = interval
+        self.jitter = jitter
+        self.streams_args = kwargs
+
+        self.versions = [None] * len(images)
+        self._updated = {}
+        self._stopped = threading.Event()
+
+    def poll(self):
+        """Check the watched mirrors once.
+
+        The first poll of a mirror records the latest serial of its images
+        without reporting them. A mirror failing to sync is logged and
+        retried on the next poll.
+
+        Returns:
+            list of event dictionaries of the images with a new serial
+
+        """
+        groups = {}
+        for position, image in enumerate(self.images):
+            key = (image.mirror_url, image.keyring_path)
+            groups.setdefault(key, []).append(position)
+
+        events = []
+        for key, positions in groups.items():
+            try:
+                events.extend(self._poll_mirror(key, positions))
+            except Exception as error:  # pylint: disable=broad-except
+                self._log.warning("poll of %s failed: %s", key[0], error)
+
+        return events
+
+    def _poll_mirror(self, key, positions):
+        """Sync a mirror if its index changed and compare the serials."""
+        (mirror_url, keyring_path) = key
+        stream = Streams(
+            mirror_url=mirror_url, keyring_path=keyring_path, **self.streams_args
+        )
+
+        updated = stream.index().get("updated")
+        if updated and self._updated.get(key) == updated:
+            self._log.debug("%s did not change", mirror_url)
+            return []
+
+        matches = stream.query_many(
+            [self.images[position].filter for position in positions],
+            [self.images[position].index_filter for position in positions],
+            latest_only=True,
+        )
+        first = key not in self._updated
+        self._updated[key] = updated
+
+        events = []
+        for position, match in zip(positions, matches):
+            result = match[0] if match else {}
+            previous = self.versions[position]
+            version_name = result.get("version_name")
+            self.versions[position] = version_name
+            if first or not version_name or version_name == previous:
+                continue
+
+            events.append(
+                {
+                    "image": repr(self.images[position]),
+                    "previous": previous,
+                    "version_name": version_name,
+                    "result": result,
+                }
+            )
+
+        return events
+
+    def run(self, callback, polls=None):
+        """Poll until stopped, calling back with each event.
+
+        Args:
+            callback: function called with each event dictionary
+            polls: number of polls before returning (default: until stopped)
+        """
+        count = 0
+        delay = 0
+        while not self._stopped.wait(delay):
+            for event in self.poll():
+                callback(event)
+
+            count += 1
+            if polls is not None and count >= polls:
+                return
+
+            delay = self.interval + random.uniform(0, self.jitter)
+
+    def stop(self):
+        """Stop polling."""
+        self._stopped.set()